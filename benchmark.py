@@ -0,0 +1,313 @@
+"""
+Synthetic yellow cab months and benchmarks of the functions in functions.py
+
+The real TLC files are some GB per month: this script writes deterministic synthetic months
+with the same columns and realistic distributions (zones, time of the day, durations,
+distances, payment types, fares), then times every analysis and measures its peak memory.
+
+usage:
+    python benchmark.py --rows 1000000 10000000 50000000 --months 2 --dir synthetic
+    python benchmark.py --rows 1000000 --only payments_per_borough make_od_matrix --output bench.jsonl
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import functions
+
+
+# Synthetic data
+
+# boroughs of the 265 zones of taxi_zone_lookup.csv (number of zones per borough)
+ZONES_PER_BOROUGH = [('EWR', 1), ('Queens', 69), ('Bronx', 43), ('Manhattan', 69),
+                     ('Staten Island', 20), ('Brooklyn', 61), ('Unknown', 2)]
+
+# share of the pickups / dropoffs of each borough (Manhattan has most of the yellow cab trips)
+BOROUGH_SHARES = {'EWR': 0.001, 'Queens': 0.06, 'Bronx': 0.004, 'Manhattan': 0.9,
+                  'Staten Island': 0.0005, 'Brooklyn': 0.03, 'Unknown': 0.0045}
+
+# relative number of pickups in each hour of the day
+HOUR_PROFILE = [3.5, 2.6, 1.9, 1.4, 1.0, 1.0, 2.2, 3.8, 4.6, 4.6, 4.4, 4.5,
+                4.7, 4.7, 4.9, 4.8, 4.3, 5.0, 5.9, 6.0, 5.5, 5.3, 5.1, 4.4]
+
+PASSENGER_PROBABILITIES = [0.01, 0.71, 0.14, 0.04, 0.02, 0.05, 0.03]
+
+# payment_type: 1 credit card, 2 cash, 3 no charge, 4 dispute
+PAYMENT_PROBABILITIES = {1: 0.70, 2: 0.28, 3: 0.01, 4: 0.01}
+
+# columns of the 2018 yellow cab files
+RAW_COLUMNS = ['VendorID', 'tpep_pickup_datetime', 'tpep_dropoff_datetime', 'passenger_count',
+               'trip_distance', 'RatecodeID', 'store_and_fwd_flag', 'PULocationID', 'DOLocationID',
+               'payment_type', 'fare_amount', 'extra', 'mta_tax', 'tip_amount', 'tolls_amount',
+               'improvement_surcharge', 'total_amount']
+
+
+def synthetic_zone_lookup():
+    """
+    Return a taxi_zone_lookup with the 265 LocationIDs and the boroughs of the real one
+    """
+    boroughs = [borough for borough, n in ZONES_PER_BOROUGH for _ in range(n)]
+    return pd.DataFrame({'LocationID': np.arange(1, len(boroughs) + 1),
+                         'Borough': boroughs,
+                         'Zone': ['Zone %d' %i for i in range(1, len(boroughs) + 1)],
+                         'service_zone': ['Yellow Zone' if b == 'Manhattan' else 'Boro Zone' for b in boroughs]})
+
+
+def synthetic_zone_geometry(taxi_zone_lookup, json_filename):
+    """
+    Write a geojson with a square for every zone (a 17 x 16 grid over New York)
+    """
+    features = []
+    for i, location_id in enumerate(taxi_zone_lookup['LocationID']):
+        x = -74.25 + 0.03 * (i % 17)
+        y = 40.50 + 0.03 * (i // 17)
+        square = [[x, y], [x + 0.03, y], [x + 0.03, y + 0.03], [x, y + 0.03], [x, y]]
+        features.append({'type': 'Feature', 'properties': {'LocationID': int(location_id)},
+                         'geometry': {'type': 'Polygon', 'coordinates': [square]}})
+    with open(json_filename, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    return json_filename
+
+
+def zone_probabilities(taxi_zone_lookup, seed):
+    """
+    Return the probability of each LocationID (index = LocationID) of being a pickup or dropoff zone:
+    the share of the borough is split among its zones with a Zipf-like popularity
+    """
+    rng = np.random.default_rng(seed)
+    ids = taxi_zone_lookup['LocationID'].to_numpy()
+    res = np.zeros(ids.max() + 1)
+    for borough, zones in taxi_zone_lookup.groupby('Borough')['LocationID']:
+        popularity = 1 / np.arange(1, len(zones) + 1) ** 1.1
+        res[rng.permutation(zones.to_numpy())] = BOROUGH_SHARES.get(borough, 0.001) * popularity / popularity.sum()
+    return res / res.sum()
+
+
+def synthetic_trips(rows, year, month, taxi_zone_lookup, seed = 0, chunk = 0, dirty = 0.002):
+    """
+    Return a dataframe with rows synthetic trips of a month (the columns of a raw TLC file)
+    input:
+    - rows
+    - year, month
+    - taxi_zone_lookup
+    - seed: the same seed gives the same trips
+    - chunk: number of the chunk, when a month is made of more calls (DEFAULT: 0)
+    - dirty: fraction of trips with pickup out of the month or total_amount <= 0,
+      removed by clean_dataframe (DEFAULT: 0.002)
+    """
+    rng = np.random.default_rng([seed, year, month, chunk])
+
+    # pickups: uniform day of the month, hour from HOUR_PROFILE
+    start = pd.Timestamp(year, month, 1)
+    days = rng.integers(0, start.days_in_month, rows)
+    hours = rng.choice(24, rows, p=np.array(HOUR_PROFILE) / sum(HOUR_PROFILE))
+    pickup = start.value // 10**9 + days * 86400 + hours * 3600 + rng.integers(0, 3600, rows)
+
+    out_of_month = rng.random(rows) < dirty / 2
+    pickup[out_of_month] -= rng.integers(40, 400, out_of_month.sum()) * 86400
+
+    # durations (log-normal, median about 11 minutes) and distances (speed about 11 mph)
+    duration = np.clip(rng.lognormal(np.log(660), 0.65, rows), 1, 86000).astype('int64')
+    speed = np.clip(rng.lognormal(np.log(11), 0.35, rows), 1, 60)
+    distance = np.round(speed * duration / 3600, 2)
+    distance[rng.random(rows) < 0.006] = 0
+
+    zones = zone_probabilities(taxi_zone_lookup, seed)
+    payment_type = rng.choice(list(PAYMENT_PROBABILITIES), rows, p=list(PAYMENT_PROBABILITIES.values()))
+
+    # fares: 2.50 initial charge, 2.50 per mile and 0.20 per minute
+    fare = np.round(2.5 + 2.5 * distance + 0.2 * duration / 60, 2)
+    tip = np.where(payment_type == 1, np.round(fare * rng.uniform(0.1, 0.25, rows), 2), 0)
+    extra = rng.choice([0, 0.5, 1], rows, p=[0.5, 0.35, 0.15])
+    total = np.round(fare + extra + 0.5 + 0.3 + tip, 2)
+    total[rng.random(rows) < dirty / 2] = 0
+
+    def tlc_strings(seconds):
+        return pd.to_datetime(seconds, unit='s').strftime(functions.TLC_DATETIME_FORMAT)
+
+    return pd.DataFrame({
+        'VendorID': rng.choice([1, 2], rows, p=[0.45, 0.55]),
+        'tpep_pickup_datetime': tlc_strings(pickup),
+        'tpep_dropoff_datetime': tlc_strings(pickup + duration),
+        'passenger_count': rng.choice(len(PASSENGER_PROBABILITIES), rows, p=PASSENGER_PROBABILITIES),
+        'trip_distance': distance,
+        'RatecodeID': rng.choice([1, 2, 5], rows, p=[0.97, 0.02, 0.01]),
+        'store_and_fwd_flag': 'N',
+        'PULocationID': rng.choice(len(zones), rows, p=zones),
+        'DOLocationID': rng.choice(len(zones), rows, p=zones),
+        'payment_type': payment_type,
+        'fare_amount': fare,
+        'extra': extra,
+        'mta_tax': 0.5,
+        'tip_amount': tip,
+        'tolls_amount': 0.0,
+        'improvement_surcharge': 0.3,
+        'total_amount': total,
+    }, columns=RAW_COLUMNS)
+
+
+def write_synthetic_month(df_name, rows, year, month, taxi_zone_lookup, seed = 0, chunksize = 1000000):
+    """
+    Write a synthetic raw month file (csv) chunksize rows at a time, so any number of rows fits in memory
+    output:
+    - df_name
+    """
+    for j, start in enumerate(range(0, rows, chunksize)):
+        chunk = synthetic_trips(min(chunksize, rows - start), year, month, taxi_zone_lookup, seed=seed, chunk=j)
+        chunk.to_csv(df_name, mode='w' if j == 0 else 'a', header=(j == 0), index=False)
+    return df_name
+
+
+def synthetic_dataset(directory, rows, months = 1, year = 2018, file_format = 'csv', seed = 0):
+    """
+    Write (if they are not there yet) the raw and cleaned months of a synthetic dataset
+    with rows trips in total, the lookup table and the zones geojson
+    output:
+    - dictionary with 'raw' and 'clean' (lists of paths), 'taxi_zone_lookup' and 'json_filename'
+    """
+    os.makedirs(directory, exist_ok=True)
+    lookup = synthetic_zone_lookup()
+    lookup.to_csv(os.path.join(directory, 'taxi_zone_lookup.csv'), index=False)
+
+    json_filename = os.path.join(directory, 'taxi_zones.json')
+    if not os.path.exists(json_filename):
+        synthetic_zone_geometry(lookup, json_filename)
+
+    raw, clean = [], []
+    for month in range(1, months + 1):
+        name = os.path.join(directory, 'yellow_tripdata_%d-%02d_%d.csv' %(year, month, rows))
+        if not os.path.exists(name):
+            write_synthetic_month(name, rows // months, year, month, lookup, seed=seed)
+        raw.append(name)
+
+        new_name = os.path.join(directory, 'clean_' + os.path.basename(name))
+        if file_format != 'csv':
+            new_name = os.path.splitext(new_name)[0] + functions.BINARY_FORMATS[file_format]
+        if not os.path.exists(new_name):
+            functions.clean_month_file(name, new_name, month, year, file_format, chunksize=1000000)
+        clean.append(new_name)
+
+    return {'raw': raw, 'clean': clean, 'taxi_zone_lookup': lookup, 'json_filename': json_filename}
+
+
+# Benchmarks: name -> function(dataset, processes)
+
+BOROUGHS = ['EWR', 'Queens', 'Bronx', 'Manhattan', 'Staten Island', 'Brooklyn']
+
+def clean_months(df_names):
+    """
+    Clean the raw months into a temporary directory
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        for month, df_name in enumerate(df_names):
+            functions.clean_month_file(df_name, os.path.join(directory, os.path.basename(df_name)), month + 1)
+    return
+
+
+BENCHMARKS = {
+    'stats': lambda d, p: functions.stats(d['clean']),
+    'clean_month_file': lambda d, p: clean_months(d['raw']),
+    'compute_daily_average': lambda d, p: functions.compute_daily_average(d['clean'], processes=p),
+    'compute_borough_averages': lambda d, p: functions.compute_borough_averages(
+        d['clean'], d['taxi_zone_lookup'], processes=p),
+    'passengers_NY_all_months': lambda d, p: functions.passengers_NY_all_months(d['clean'], processes=p),
+    'passengers_per_hour': lambda d, p: functions.passengers_per_hour(
+        d['clean'], d['taxi_zone_lookup'], processes=p),
+    'make_duration_df': lambda d, p: functions.make_duration_df(d['clean'], d['taxi_zone_lookup'], processes=p),
+    'payments_per_borough': lambda d, p: functions.payments_per_borough(
+        d['clean'], d['taxi_zone_lookup'], BOROUGHS, processes=p),
+    'duration_distance_df': lambda d, p: functions.duration_distance_df(d['clean'], processes=p),
+    'make_df_price_per_mile': lambda d, p: functions.make_df_price_per_mile(
+        d['clean'], d['taxi_zone_lookup'], processes=p),
+    'take_pickup_and_dropoff_zones': lambda d, p: functions.take_pickup_and_dropoff_zones(
+        d['clean'], d['taxi_zone_lookup'], processes=p),
+    'make_od_matrix': lambda d, p: functions.make_od_matrix(d['clean'], d['taxi_zone_lookup'], processes=p),
+    'make_zone_hour_cube': lambda d, p: functions.make_zone_hour_cube(
+        d['clean'], d['taxi_zone_lookup'], processes=p),
+    'pickup_and_dropoff_maps': lambda d, p: functions.pickup_and_dropoff_maps(
+        d['clean'], d['taxi_zone_lookup'], d['json_filename'], processes=p, shared_geometry=True),
+}
+
+
+def max_rss():
+    """
+    Return the peak resident memory of this process in bytes
+    (ru_maxrss is in kilobytes on linux and in bytes on mac os)
+    """
+    res = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return res if sys.platform == 'darwin' else res * 1024
+
+
+def run_benchmark(name, dataset, processes):
+    """
+    Run a benchmark (in a new process, see measure) and return its time and memory:
+    peak_rss_bytes is the peak of the process, added_rss_bytes the part added by the benchmark
+    (the worker processes of processes > 1 are not included)
+    """
+    functions.clear_trip_store()
+    rss_before = max_rss()
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        BENCHMARKS[name](dataset, processes)
+    seconds = time.perf_counter() - start
+
+    peak = max_rss()
+    return {'benchmark': name, 'seconds': seconds, 'peak_rss_bytes': peak, 'added_rss_bytes': peak - rss_before}
+
+
+def measure(name, dataset, processes):
+    """
+    Run a benchmark in a new process, so that its peak memory doesn't include the previous ones
+    """
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(run_benchmark, name, dataset, processes).result()
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000000, 10000000, 50000000],
+                        help='total trips of each dataset')
+    parser.add_argument('--months', type=int, default=1, help='months of each dataset')
+    parser.add_argument('--dir', default='synthetic', help='directory of the synthetic files')
+    parser.add_argument('--format', default='csv', choices=['csv'] + list(functions.BINARY_FORMATS),
+                        help='format of the cleaned months')
+    parser.add_argument('--processes', type=int, default=1, help='worker processes of the analyses')
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each benchmark (the best one is kept)')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='benchmarks to run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='json lines file where the results are appended')
+    args = parser.parse_args(argv)
+
+    print('%-32s %12s %10s %12s %12s' %('benchmark', 'rows', 'seconds', 'added MB', 'max rss MB'))
+
+    for rows in args.rows:
+        dataset = synthetic_dataset(args.dir, rows, args.months, file_format=args.format, seed=args.seed)
+
+        for name in args.only or BENCHMARKS:
+            res = min((measure(name, dataset, args.processes) for _ in range(args.repeat)),
+                      key=lambda r: r['seconds'])
+            res.update(rows=rows, months=args.months, format=args.format, processes=args.processes)
+
+            print('%-32s %12d %10.2f %12.1f %12.1f' %(name, rows, res['seconds'],
+                                                      res['added_rss_bytes'] / 2**20, res['peak_rss_bytes'] / 2**20))
+            if args.output:
+                with open(args.output, 'a') as f:
+                    f.write(json.dumps(res) + '\n')
+    return
+
+
+if __name__ == '__main__':
+    main()
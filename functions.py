@@ -3,92 +3,2516 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 import time
+import os
+import re
+import math
+import itertools
+import hashlib
+import pickle
+import shutil
+import inspect
+import functools
+import types
 
 import json
 import folium
 import geojson
+from branca.colormap import StepColormap
+from branca.element import MacroElement, Template
 
 
 from collections import defaultdict # see function compute_borough_averages
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from scipy.special import stdtr # cdf of the Student's t distribution, see welch_p_values
 
-# Function that provides (and prints) some informations about the different csv files
-def stats(df_names):
+try:
+    import resource
+except ImportError:
+    # windows: the peak memory of the stages is not measured
+    resource = None
+
+
+# Instrumentation
+#
+# The loaders and the aggregations report their stages (read, parse, filter, groupby, merge, plot...)
+# as events: dictionaries with stage name, seconds, rows in and out, resident memory of the process
+# at the start and at the end of the stage and how much its peak grew during the stage.
+# The events are given to the sinks added with add_event_sink (e.g. a JsonLinesSink);
+# when there are no sinks the stages cost nothing more than a function call.
+# The events of the worker processes (processes > 1) are sent back to the parent with the results
+# and given to its sinks there.
+
+_event_sinks = []
+
+
+def add_event_sink(sink):
+    """
+    Add a sink: any function taking an event (dictionary), e.g. a JsonLinesSink or list.append
+    """
+    _event_sinks.append(sink)
+    return sink
+
+
+def remove_event_sink(sink):
+    """
+    Remove a sink added with add_event_sink
+    """
+    if sink in _event_sinks:
+        _event_sinks.remove(sink)
+    return
+
+
+class instrumentation:
+    """
+    Context manager adding a sink only inside a with block:
+        with instrumentation(JsonLinesSink('run.jsonl')):
+            compute_daily_average(df_names)
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+
+    def __enter__(self):
+        return add_event_sink(self.sink)
+
+    def __exit__(self, exc_type, exc, tb):
+        remove_event_sink(self.sink)
+        return False
+
+
+class JsonLinesSink:
+    """
+    Sink appending every event as a line of json to a file
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, event):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(event, default=str) + '\n')
+
+
+def current_rss():
+    """
+    Return the resident memory of the process in bytes now (None if it can't be measured, e.g. not on linux)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss():
+    """
+    Return the peak resident memory of the process in bytes (None if it can't be measured),
+    it never decreases: the peak of a stage is only visible as an increase of it
+    """
+    if resource is None:
+        return None
+    res = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac os
+    return res if os.uname().sysname == 'Darwin' else res * 1024
+
+
+def emit(event):
+    """
+    Give an event to all the sinks
+    (the events forwarded from the workers keep their time and pid)
+    """
+    event.setdefault('time', time.time())
+    event.setdefault('pid', os.getpid())
+    for sink in list(_event_sinks):
+        sink(event)
+    return
+
+
+class Stage:
+    """
+    Timed stage of the pipeline, made by stage(): the event is emitted at the end of the with block
+    """
+
+    def __init__(self, name, rows_in, fields):
+        self.event = dict(stage=name, rows_in=rows_in, rows_out=None, **fields)
+
+    def __enter__(self):
+        self.event['rss_start_bytes'] = current_rss()
+        self.peak_start = peak_rss()
+        self.start = time.perf_counter()
+        return self
+
+    def rows(self, rows_out):
+        """
+        Record the rows produced by the stage
+        """
+        self.event['rows_out'] = rows_out
+        return
+
+    def __exit__(self, exc_type, exc, tb):
+        self.event['seconds'] = time.perf_counter() - self.start
+        self.event['rss_end_bytes'] = current_rss()
+        # 0 if the stage stayed below the previous peak of the process
+        peak = peak_rss()
+        self.event['max_rss_increase_bytes'] = None if peak is None else peak - self.peak_start
+        if exc_type is not None:
+            self.event['error'] = exc_type.__name__
+        emit(self.event)
+        return False
+
+
+class _NullStage:
+    """
+    Stage used when there are no sinks: does nothing
+    """
+
+    def __enter__(self):
+        return self
+
+    def rows(self, rows_out):
+        return
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name, rows_in = None, **fields):
+    """
+    Return a context manager timing a stage of the pipeline:
+        with stage('filter', rows_in=len(df), df_name=df_name) as st:
+            df = df[...]
+            st.rows(len(df))
+    input:
+    - name of the stage ('read', 'parse', 'filter', 'groupby', 'merge', 'plot', ...)
+    - rows_in: rows given to the stage (DEFAULT: None)
+    - other fields of the event (e.g. df_name)
+    """
+    if not _event_sinks:
+        return _NULL_STAGE
+    return Stage(name, rows_in, fields)
+
+
+def instrumented(name):
+    """
+    Decorator emitting a stage event (with the name of the function) for every call of a function
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _event_sinks:
+                return func(*args, **kwargs)
+            with Stage(name, None, {'function': func.__name__}) as st:
+                res = func(*args, **kwargs)
+                if isinstance(res, (pd.Series, pd.DataFrame)):
+                    st.rows(len(res))
+            return res
+        return wrapper
+    return decorator
+
+
+class InstrumentedKernel:
+    """
+    Per-month kernel emitting a 'month' stage for every call (in the process running it)
+    """
+
+    def __init__(self, kernel, name):
+        self.kernel = kernel
+        self.name = name
+
+    def __call__(self, df_name, *args):
+        with stage('month', kernel=self.name, df_name=df_name):
+            return self.kernel(df_name, *args)
+
+
+class ForwardingKernel:
+    """
+    Kernel run in a worker process returning (result, events emitted by the kernel), so that the parent
+    gives the events to its own sinks (lists and functions of the parent don't exist in the worker)
+    """
+
+    def __init__(self, kernel):
+        self.kernel = kernel
+
+    def __call__(self, *args):
+        events = []
+        sinks = list(_event_sinks)
+        # the sinks inherited with fork would write the events twice
+        _event_sinks[:] = [events.append]
+        try:
+            res = self.kernel(*args)
+        finally:
+            _event_sinks[:] = sinks
+        return res, events
+
+
+def forwarded(result):
+    """
+    Emit the events of a result of a ForwardingKernel and return the result of the kernel
+    """
+    res, events = result
+    for event in events:
+        emit(event)
+    return res
+
+
+# Shared ingestion layer
+#
+# Every analysis below needs only a handful of the 17 columns of a yellow cab csv file.
+# Each column of a month is read and parsed once (with its compact dtype) and kept in _trip_store:
+# binary files are read one column at a time when an analysis asks for it, csv files are parsed
+# once for all their TRIP_COLUMNS. The least recently used columns are dropped when the store
+# is bigger than its budget.
+
+# columns used by the analyses and their dtypes: the integer columns are nullable, since some files
+# (e.g. 2019 onwards) have trips without passenger_count, payment_type...
+# The kernels turn the missing values into the code -1 (see int_codes), so those trips aren't counted
+# in the tables of that column.
+TRIP_DTYPES = {'passenger_count': 'UInt8', 'trip_distance': 'float64',
+               'PULocationID': 'UInt16', 'DOLocationID': 'UInt16', 'payment_type': 'UInt8',
+               'fare_amount': 'float64', 'total_amount': 'float64'}
+DATETIME_COLUMNS = ['tpep_pickup_datetime', 'tpep_dropoff_datetime']
+TRIP_COLUMNS = DATETIME_COLUMNS + list(TRIP_DTYPES)
+
+# dtypes of the other columns of the raw files, used when they are read to be cleaned:
+# every chunk gets the same dtypes whatever its values (e.g. tolls_amount all 0 in a chunk)
+RAW_DTYPES = {'VendorID': 'UInt8', 'RatecodeID': 'UInt8', 'store_and_fwd_flag': 'string',
+              'extra': 'float64', 'mta_tax': 'float64', 'tip_amount': 'float64', 'tolls_amount': 'float64',
+              'improvement_surcharge': 'float64', 'congestion_surcharge': 'float64',
+              'airport_fee': 'float64', 'Airport_fee': 'float64', **TRIP_DTYPES}
+
+
+
+def file_signature(df_name):
+    """
+    Return (modification time, size) of a file, used to notice when a file changed
+    """
+    st = os.stat(df_name)
+    return (st.st_mtime_ns, st.st_size)
+
+
+# binary formats written by make_new_csv (parquet and arrow IPC) and their file extension
+BINARY_FORMATS = {'parquet': '.parquet', 'feather': '.feather'}
+
+
+def trips_format(df_name):
+    """
+    Return the format of a month file from its extension ('csv', 'parquet' or 'feather')
+    """
+    ext = os.path.splitext(df_name)[1].lower()
+    for file_format, format_ext in BINARY_FORMATS.items():
+        if ext == format_ext:
+            return file_format
+    if ext == '.arrow':
+        return 'feather'
+    return 'csv'
+
+
+# TLC timestamps
+#
+# The datetimes of the TLC files are always written as 'YYYY-MM-DD HH:MM:SS'. Instead of the generic
+# datetime parsing of pandas, the 19 bytes of each string are read as digits and converted
+# to seconds since the epoch with integer arithmetic on whole columns.
+
+TLC_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# position of the digits and of the separators in 'YYYY-MM-DD HH:MM:SS'
+_TLC_DIGITS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+_TLC_SEPARATORS = {4: b'-', 7: b'-', 10: b' ', 13: b':', 16: b':'}
+
+
+def days_from_civil(year, month, day):
+    """
+    Return the days since 1970-01-01 of dates given as year, month, day (integer arrays)
+    """
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def civil_from_days(days):
+    """
+    Return (year, month, day) of the days since 1970-01-01 (int64 arrays)
+    """
+    days = np.asarray(days, dtype='int64') + 719468
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    mp = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * mp + 2) // 5 + 1
+    month = np.where(mp < 10, mp + 3, mp - 9)
+    return year_of_era + era * 400 + (month <= 2), month, day
+
+
+def calendar_fields(seconds):
+    """
+    Return a dictionary with the 'year', 'month', 'day', 'hour' and 'weekday' (0 = Monday)
+    of the seconds since the epoch (int64 arrays)
+    """
+    seconds = np.asarray(seconds, dtype='int64')
+    days = seconds // 86400
+    year, month, day = civil_from_days(days)
+    return {'year': year, 'month': month, 'day': day,
+            'hour': seconds // 3600 % 24, 'weekday': (days + 3) % 7}
+
+
+def tlc_seconds(values):
+    """
+    Return the seconds since the epoch (int64 array) of TLC datetime strings ('YYYY-MM-DD HH:MM:SS')
+    input:
+    - strings (column, array or pyarrow array); datetime columns are converted directly
+    output:
+    - int64 array; columns with other formats or missing values are parsed by pandas
+      (missing values become the int64 of NaT)
+    """
+    import pyarrow as pa
+    
+    if isinstance(values, pd.Series) and pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return epoch_seconds(values)
+    
+    arr = values if isinstance(values, (pa.Array, pa.ChunkedArray)) else pa.array(values, from_pandas=True)
+    if isinstance(arr, pa.ChunkedArray):
+        arr = arr.combine_chunks()
+    
+    if len(arr) == 0:
+        return np.zeros(0, dtype='int64')
+    
+    if pa.types.is_string(arr.type) or pa.types.is_large_string(arr.type):
+        arr = arr.cast(pa.large_string())
+        offsets = np.frombuffer(arr.buffers()[1], dtype='int64')[arr.offset:arr.offset + len(arr) + 1]
+        
+        # all the strings have 19 bytes: the data buffer is a (rows, 19) matrix of characters
+        if arr.null_count == 0 and offsets[-1] - offsets[0] == 19 * len(arr) and (np.diff(offsets) == 19).all():
+            chars = np.frombuffer(arr.buffers()[2], dtype='uint8')[offsets[0]:offsets[-1]].reshape(-1, 19)
+            
+            valid = ((chars[:, _TLC_DIGITS] - ord('0')) < 10).all()
+            for col, sep in _TLC_SEPARATORS.items():
+                valid = valid and (chars[:, col] == ord(sep)).all()
+            
+            if valid:
+                def number(start, stop):
+                    res = chars[:, start].astype('int32') - ord('0')
+                    for col in range(start + 1, stop):
+                        res = res * 10 + (chars[:, col] - ord('0'))
+                    return res
+                
+                days = days_from_civil(number(0, 4), number(5, 7), number(8, 10)).astype('int64')
+                return days * 86400 + (number(11, 13) * 3600 + number(14, 16) * 60 + number(17, 19))
+    
+    # other formats, missing values...
+    datetimes = pd.to_datetime(pd.Series(arr.to_pandas()), format=TLC_DATETIME_FORMAT)
+    return datetimes.values.astype('datetime64[s]').astype('int64')
+
+
+def compact_trips(df):
+    """
+    Cast the TRIP_COLUMNS of a dataframe to their compact dtypes,
+    datetimes are stored as int64 seconds since the epoch
+    input:
+    - dataframe (datetime columns can be strings or datetimes)
+    output:
+    - the same dataframe with compact columns
+    """
+    for col in DATETIME_COLUMNS:
+        if col in df.columns:
+            df[col] = tlc_seconds(df[col])
+    for col, dtype in TRIP_DTYPES.items():
+        if col in df.columns:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def int_codes(values, missing = -1):
+    """
+    Return the int64 array of an integer column (nullable or not) or array,
+    with missing values replaced by `missing` (DEFAULT: -1, outside every table of counts)
+    """
+    if isinstance(values, (pd.Series, pd.Index, pd.api.extensions.ExtensionArray)):
+        return values.to_numpy(dtype='int64', na_value=missing)
+    return np.asarray(values, dtype='int64')
+
+
+def trip_dtypes(columns, dtypes = None):
+    """
+    Return the dtypes of TRIP_DTYPES (or of dtypes, for the other columns) for the given columns
+    """
+    dtypes = TRIP_DTYPES if dtypes is None else {**dtypes, **TRIP_DTYPES}
+    return {col: dtypes[col] for col in columns if col in dtypes}
+
+
+def stable_dtypes(df):
+    """
+    Cast the columns of a raw dataframe (or chunk) to dtypes which don't depend on its values:
+    RAW_DTYPES for the known columns, float64 for the other numeric columns and strings for the rest
+    (datetime columns are left to compact_trips). So all the chunks of a month, even an empty or
+    all-null one, are written with the same schema.
+    """
+    dtypes = {}
+    for col in df.columns:
+        if col in DATETIME_COLUMNS:
+            continue
+        if col in RAW_DTYPES:
+            dtypes[col] = RAW_DTYPES[col]
+        elif pd.api.types.is_numeric_dtype(df[col].dtype) and not pd.api.types.is_bool_dtype(df[col].dtype):
+            dtypes[col] = 'float64'
+        elif not pd.api.types.is_bool_dtype(df[col].dtype):
+            dtypes[col] = 'string'
+    return df.astype(dtypes)
+
+
+def write_trips(df, df_name, file_format):
+    """
+    Write a cleaned month as parquet or arrow IPC (feather) file with compact dtypes
+    input:
+    - dataframe
+    - path of the new file
+    - file_format: 'parquet' or 'feather'
+    """
+    write_trips_chunks([df], df_name, file_format)
+    return
+
+
+def write_trips_chunks(chunks, df_name, file_format):
+    """
+    Same of write_trips, but the month is given as an iterable of dataframes
+    which are written one at a time (parquet row groups / arrow record batches)
+    input:
+    - iterable of dataframes with the same columns
+    - path of the new file
+    - file_format: 'parquet' or 'feather'
+    The chunks are cast with stable_dtypes and compact_trips, so they all have the schema of the first one;
+    the file is written with a temporary name and renamed at the end (no half-written file on errors).
+    """
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+    
+    if file_format not in BINARY_FORMATS:
+        raise ValueError("unknown file format %s" %file_format)
+    
+    tmp = '%s.%d.tmp' %(df_name, os.getpid())
+    writer = None
+    schema = None
+    
+    try:
+        for chunk in chunks:
+            # the schema of the first chunk is used for all the others
+            chunk = compact_trips(stable_dtypes(chunk.reset_index(drop=True)))
+            table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+            if writer is None:
+                schema = table.schema
+                if file_format == 'parquet':
+                    writer = pyarrow.parquet.ParquetWriter(tmp, schema)
+                else:
+                    writer = pyarrow.ipc.new_file(tmp, schema)
+            writer.write_table(table)
+        
+        if writer is not None:
+            writer.close()
+            writer = None
+            os.replace(tmp, df_name)
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return
+
+
+def parse_datetimes(df, from_seconds = False):
+    """
+    Convert the DATETIME_COLUMNS found in df to datetimes
+    input:
+    - dataframe
+    - from_seconds: True if the columns are int64 seconds (binary files), False if strings
+    output:
+    - the same dataframe
+    """
+    with stage('parse', rows_in=len(df)) as st:
+        for col in DATETIME_COLUMNS:
+            if col in df.columns:
+                seconds = df[col].to_numpy(dtype='int64') if from_seconds else tlc_seconds(df[col])
+                df[col] = pd.to_datetime(seconds, unit='s')
+        st.rows(len(df))
+    return df
+
+
+def read_trips(df_name, columns = None, dtypes = None):
+    """
+    Read and parse the columns of a month file (csv, parquet or feather)
+    input:
+    - path of the file
+    - columns: list of columns to read (in TRIP_COLUMNS or in dtypes);
+      if None (DEFAULT) all the TRIP_COLUMNS found in the file
+    - dtypes: dtypes of the requested columns which aren't in TRIP_COLUMNS (DEFAULT: None)
+    output:
+    - dataframe with the requested columns (only those are read from disk)
+    """
+    file_format = trips_format(df_name)
+    
+    with stage('read', df_name=df_name, format=file_format,
+               columns=None if columns is None else list(columns)) as st:
+        if file_format == 'csv':
+            usecols = (lambda col: col in TRIP_COLUMNS) if columns is None else list(columns)
+            dtype = trip_dtypes(TRIP_COLUMNS if columns is None else columns, dtypes)
+            df = pd.read_csv(df_name, usecols=usecols, dtype=dtype)
+        else:
+            # binary files: only the needed columns are read from disk
+            import pyarrow.ipc
+            import pyarrow.parquet
+            
+            if file_format == 'parquet':
+                if columns is None:
+                    names = pyarrow.parquet.read_schema(df_name).names
+                    columns = [col for col in TRIP_COLUMNS if col in names]
+                df = pd.read_parquet(df_name, columns=list(columns))
+            else:
+                if columns is None:
+                    names = pyarrow.ipc.open_file(df_name).schema.names
+                    columns = [col for col in TRIP_COLUMNS if col in names]
+                df = pd.read_feather(df_name, columns=list(columns))
+            # e.g. files written without pandas metadata: integer columns with nulls come back as floats
+            df = df.astype(trip_dtypes(df.columns, dtypes))
+        if columns is not None:
+            df = df[list(columns)]
+        st.rows(len(df))
+    
+    return parse_datetimes(df, from_seconds=(file_format != 'csv'))
+
+
+def iter_trips(df_name, columns, chunksize = None, dtypes = None):
+    """
+    Yield the requested columns of a month as dataframes of at most chunksize rows
+    input:
+    - path of the file (csv, parquet or feather)
+    - list of columns (in TRIP_COLUMNS or in dtypes)
+    - chunksize: if None (DEFAULT) the whole month is taken from the store with load_trips,
+      otherwise the file is streamed from disk without keeping it in memory
+    - dtypes: dtypes of the requested columns which aren't in TRIP_COLUMNS (e.g. DIMENSION_DTYPES):
+      if there are any, the whole month is read from the file and not kept in the store (DEFAULT: None)
+    """
+    columns = list(columns)
+    
+    if chunksize is None:
+        if all(col in TRIP_COLUMNS for col in columns):
+            yield load_trips(df_name, columns)
+        else:
+            yield read_trips(df_name, columns, dtypes)
+        return
+    
+    file_format = trips_format(df_name)
+    
+    if file_format == 'csv':
+        for chunk in pd.read_csv(df_name, usecols=columns, dtype=trip_dtypes(columns, dtypes), chunksize=chunksize):
+            yield parse_datetimes(chunk[columns])
+        return
+    
+    import pyarrow.ipc
+    import pyarrow.parquet
+    
+    if file_format == 'parquet':
+        batches = pyarrow.parquet.ParquetFile(df_name).iter_batches(batch_size=chunksize, columns=columns)
+    else:
+        reader = pyarrow.ipc.open_file(df_name)
+        batches = (batch.slice(start, chunksize)
+                   for batch in (reader.get_batch(i).select(columns) for i in range(reader.num_record_batches))
+                   for start in range(0, batch.num_rows, chunksize))
+    
+    # the chunks are numbered with the row numbers in the file, as the csv chunks
+    rows = 0
+    for batch in batches:
+        chunk = batch.to_pandas().astype(trip_dtypes(columns, dtypes))
+        chunk.index = pd.RangeIndex(rows, rows + len(chunk))
+        rows += len(chunk)
+        yield parse_datetimes(chunk, from_seconds=True)
+    return
+
+
+class TripStore:
+    """
+    Columns of the months read by load_trips, kept in memory up to max_bytes
+    (the least recently used columns are dropped first)
+    """
+
+    def __init__(self, max_bytes = 2 << 30):
+        self.max_bytes = max_bytes
+        # (absolute path of the file, column) -> (file signature, series), oldest use first
+        self.columns = OrderedDict()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.columns)
+
+    def get(self, df_name, columns):
+        """
+        Return a new dataframe with the requested columns of a month, reading from the file
+        only the columns which aren't in the store (or all of them again if the file changed on disk).
+        A csv file can't be read one column at a time: parsing it is the expensive part, so on a miss
+        all its TRIP_COLUMNS are read and the ones not requested are kept too, if they fit in max_bytes
+        without dropping other columns (each csv month is parsed once, unless its columns are dropped).
+        Parquet and feather files read only the missing columns.
+        """
+        path = os.path.abspath(df_name)
+        signature = file_signature(df_name)
+        
+        found = {}
+        for col in columns:
+            entry = self.columns.get((path, col))
+            if entry is not None and entry[0] == signature:
+                self.columns.move_to_end((path, col))
+                found[col] = entry[1]
+            elif entry is not None:
+                self.pop((path, col))
+        
+        missing = [col for col in columns if col not in found]
+        if missing:
+            if trips_format(df_name) == 'csv' and self.max_bytes > 0:
+                df = read_trips(df_name)
+                for col in df.columns:
+                    entry = self.columns.get((path, col))
+                    if col in missing or (entry is not None and entry[0] == signature):
+                        continue
+                    if entry is not None:
+                        self.pop((path, col))
+                    if self.nbytes + df[col].memory_usage(index=False) <= self.max_bytes:
+                        self.put(path, col, signature, df[col])
+            else:
+                df = read_trips(df_name, missing)
+            for col in missing:
+                found[col] = df[col]
+                self.put(path, col, signature, df[col])
+        
+        res = pd.DataFrame({col: found[col] for col in columns})
+        self.evict()
+        return res
+
+    def put(self, path, col, signature, series):
+        """
+        Add a column to the store (as the most recently used one)
+        """
+        self.columns[(path, col)] = (signature, series)
+        self.nbytes += series.memory_usage(index=False)
+        return
+
+    def pop(self, key):
+        """
+        Remove a column from the store
+        """
+        signature, series = self.columns.pop(key)
+        self.nbytes -= series.memory_usage(index=False)
+        return
+
+    def evict(self):
+        """
+        Remove the least recently used columns until the store fits in max_bytes
+        """
+        while self.columns and self.nbytes > self.max_bytes:
+            self.pop(next(iter(self.columns)))
+        return
+
+    def clear(self, df_names = None):
+        """
+        Remove the columns of the given months (all of them if df_names is None)
+        """
+        paths = None if df_names is None else set(os.path.abspath(df_name) for df_name in df_names)
+        for key in list(self.columns):
+            if paths is None or key[0] in paths:
+                self.pop(key)
+        return
+
+
+_trip_store = TripStore()
+
+
+def set_trip_store_budget(max_bytes):
+    """
+    Set the memory budget of the store of the months (0 keeps nothing in memory)
+    """
+    _trip_store.max_bytes = max_bytes
+    _trip_store.evict()
+    return _trip_store
+
+
+def load_trips(df_name, columns):
+    """
+    Return the requested columns of a month, reading each column from the file only the first time
+    (or again if the file changed on disk, or if the column was dropped to fit the budget of the store)
+    input:
+    - path of the file (csv, parquet or feather)
+    - list of columns (must be in TRIP_COLUMNS)
+    output:
+    - a new dataframe with only the requested columns
+    """
+    return _trip_store.get(df_name, list(columns))
+
+
+def clear_trip_store(df_names = None):
+    """
+    Free the memory of the months in the store (all of them if df_names is None);
+    not needed for correctness: changed files are read again and the store has a budget
+    """
+    _trip_store.clear(df_names)
+    return
+
+
+def concat_months(frames):
+    """
+    Concatenate the dataframes of the months with a single copy
+    (instead of appending them one at a time)
+    input:
+    - iterable of dataframes
+    output:
+    - a dataframe (empty if there are no months)
+    """
+    frames = list(frames)
+    if len(frames) == 0:
+        return pd.DataFrame()
+    with stage('concat', rows_in=sum(len(frame) for frame in frames), parts=len(frames)) as st:
+        res = pd.concat(frames)
+        st.rows(len(res))
+    return res
+
+
+def imap_months(kernel, df_names, *args, processes = 1, aggregates = None):
+    """
+    Generator yielding kernel(df_name, *args) for every month, in the order of df_names
+    input:
+    - kernel: module level function computing the (partial) result of a single month
+    - df_names
+    - other arguments of kernel (they are sent to every worker process)
+    - processes: number of worker processes running the months in parallel (DEFAULT: 1, no workers)
+    - aggregates: an AggregateStore (or its directory): the results of the months already
+      computed are taken from it, the others are computed and saved there (DEFAULT: None)
+    """
+    name = kernel.__name__
+    if aggregates is not None:
+        kernel = StoredKernel(aggregate_store(aggregates), kernel)
+    if _event_sinks:
+        kernel = InstrumentedKernel(kernel, name)
+    
+    if processes == 1 or len(df_names) <= 1:
+        for df_name in df_names:
+            yield kernel(df_name, *args)
+        return
+    
+    # the events of the workers are given to the sinks of this process
+    forward = bool(_event_sinks)
+    if forward:
+        kernel = ForwardingKernel(kernel)
+    
+    with ProcessPoolExecutor(max_workers=min(processes, len(df_names))) as executor:
+        for result in executor.map(kernel, df_names, *[itertools.repeat(arg) for arg in args]):
+            yield forwarded(result) if forward else result
+    return
+
+
+def map_months(kernel, df_names, *args, processes = 1, aggregates = None):
+    """
+    Same of imap_months, but returns the list of the results
+    """
+    return list(imap_months(kernel, df_names, *args, processes=processes, aggregates=aggregates))
+
+
+def merge_partials(partials):
+    """
+    Merge the partial results of the months (or of the chunks):
+    - pandas series/dataframes are summed aligning their indexes (missing values count as 0)
+    - objects with a merge method (e.g. TripsPerDay) are merged with it
+    - anything else (numbers, numpy arrays) is summed
+    ValueError is raised if there are no partials
+    """
+    partials = list(partials)
+    if len(partials) == 0:
+        # e.g. reduce_months with an empty list of months: there is no result of the right type to return
+        raise ValueError("no partial results to merge (empty list of months?)")
+    
+    with stage('merge', parts=len(partials)):
+        if isinstance(partials[0], (pd.Series, pd.DataFrame)):
+            res = pd.concat(partials)
+            return res.groupby(level=list(range(res.index.nlevels)), observed=True).sum()
+        
+        res = partials[0]
+        for partial in partials[1:]:
+            if hasattr(res, 'merge'):
+                res = res.merge(partial)
+            else:
+                res = res + partial
+    return res
+
+
+def reduce_months(kernel, df_names, *args, processes = 1, aggregates = None):
+    """
+    Apply kernel to every month (see imap_months) and merge the partial results with merge_partials
+    """
+    return merge_partials(imap_months(kernel, df_names, *args, processes=processes, aggregates=aggregates))
+
+
+def load_months(month_loader, df_names, *args, lazy = False, processes = 1):
+    """
+    Apply month_loader(df_name, *args) to every month and put the results together
+    input:
+    - month_loader: function returning the dataframe of a single month
+    - df_names
+    - other arguments of month_loader
+    - lazy: if True, return a generator which yields one month at a time
+      (DEFAULT: False, a single dataframe with all the months)
+    - processes: number of worker processes loading the months (DEFAULT: 1)
+    """
+    months = imap_months(month_loader, df_names, *args, processes=processes)
+    if lazy:
+        return months
+    return concat_months(months)
+
+
+# Aggregate store
+#
+# The partial results of the months (counters, contingency tables, matrices, histograms...)
+# are saved on disk, keyed by the kernel, its arguments and the content hash of the month file.
+# When a month is added only its partials are computed, the others are read back.
+# The key also contains the hash of the code of the kernel and AGGREGATES_VERSION, so the partials
+# saved by an older kernel are not reused: AGGREGATES_VERSION is increased when the helpers
+# called by the kernels change their results (e.g. the handling of missing values).
+
+AGGREGATES_VERSION = 2
+
+
+def code_hash(func):
+    """
+    Return the hash of the bytecode, constants and names of a function (and of the functions defined in it);
+    the same in every process and run, unlike the hash of the code object
+    """
+    digest = hashlib.sha1()
+    
+    def add(code):
+        digest.update(code.co_code)
+        digest.update(' '.join(code.co_names).encode())
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                add(const)
+            else:
+                digest.update(repr(const).encode())
+    
+    code = getattr(func, '__code__', None)
+    if code is not None:
+        add(code)
+    return digest.hexdigest()
+
+class AggregateStore:
+    """
+    Directory with the saved partial results of the per-month kernels:
+    <directory>/<kernel name>/<file hash>-<arguments hash>.pkl
+    (the arguments hash includes AGGREGATES_VERSION and the code_hash of the kernel)
+    The content hashes of the files are kept in <directory>/hashes and recomputed
+    only when the modification time or the size of a file change.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, 'hashes'), exist_ok=True)
+
+    def content_hash(self, df_name):
+        """
+        Return the hash (blake2b) of the content of a file
+        """
+        signature = list(file_signature(df_name))
+        name = hashlib.sha1(os.path.abspath(df_name).encode()).hexdigest() + '.json'
+        path = os.path.join(self.directory, 'hashes', name)
+        
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved['signature'] == signature:
+                return saved['hash']
+        
+        digest = hashlib.blake2b(digest_size=20)
+        with open(df_name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                digest.update(block)
+        
+        write_atomically(path, json.dumps({'signature': signature, 'hash': digest.hexdigest()}).encode())
+        return digest.hexdigest()
+
+    def path_of(self, kernel, df_name, args):
+        """
+        Return the path of the saved result of kernel(df_name, *args)
+        """
+        args_hash = hashlib.sha1(pickle.dumps((AGGREGATES_VERSION, code_hash(kernel), args))).hexdigest()[:16]
+        return os.path.join(self.directory, kernel.__name__,
+                            '%s-%s.pkl' %(self.content_hash(df_name), args_hash))
+
+    def get(self, kernel, df_name, *args):
+        """
+        Return kernel(df_name, *args), computing and saving it only if it isn't saved yet
+        """
+        path = self.path_of(kernel, df_name, args)
+        
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        
+        res = kernel(df_name, *args)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomically(path, pickle.dumps(res, protocol=pickle.HIGHEST_PROTOCOL))
+        return res
+
+    def clear(self, kernel = None):
+        """
+        Remove the saved results (only the ones of kernel, if given)
+        """
+        names = [kernel.__name__] if kernel is not None else [n for n in os.listdir(self.directory) if n != 'hashes']
+        for name in names:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        return
+
+
+class StoredKernel:
+    """
+    A kernel whose results are taken from (or saved into) an AggregateStore,
+    it can be sent to worker processes as the kernel itself
+    """
+
+    def __init__(self, aggregates, kernel):
+        self.aggregates = aggregates
+        self.kernel = kernel
+
+    def __call__(self, df_name, *args):
+        return self.aggregates.get(self.kernel, df_name, *args)
+
+
+def aggregate_store(aggregates):
+    """
+    Return an AggregateStore (aggregates can be the store or its directory)
+    """
+    if isinstance(aggregates, AggregateStore):
+        return aggregates
+    return AggregateStore(aggregates)
+
+
+def write_atomically(path, data):
+    """
+    Write bytes in a file, so that readers never see a partially written file
+    """
+    tmp = '%s.%d.tmp' %(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return
+
+
+# Loader cache
+#
+# The results of the loaders (make_df_price_per_mile, make_duration_df, ...) are saved on disk,
+# keyed by the function, its arguments and the signature of the files it reads, so that running
+# the same cell again only reads the saved result. Dataframes are saved as parquet files.
+# The least recently used results are removed when the cache is bigger than max_bytes.
+
+class LoaderCache:
+    """
+    Directory with the saved results of the functions decorated with disk_memoize
+    (directory None disables the cache)
+    """
+
+    def __init__(self, directory = None, max_bytes = 8 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, func, arguments):
+        """
+        Return the key of func called with arguments (dictionary name -> value)
+        """
+        token = (func.__module__, func.__qualname__, cache_token(arguments))
+        return hashlib.sha1(pickle.dumps(token)).hexdigest()
+
+    def paths_of(self, func, key):
+        """
+        Return the possible paths of a saved result (parquet for dataframes, pickle otherwise)
+        """
+        path = os.path.join(self.directory, '%s-%s' %(func.__name__, key))
+        return [path + '.parquet', path + '.pkl']
+
+    def get(self, func, key):
+        """
+        Return (True, saved result) or (False, None) if it isn't saved
+        """
+        for path in self.paths_of(func, key):
+            if os.path.exists(path):
+                # the modification time records the last use (see evict)
+                os.utime(path)
+                if path.endswith('.parquet'):
+                    return True, pd.read_parquet(path)
+                with open(path, 'rb') as f:
+                    return True, pickle.load(f)
+        return False, None
+
+    def put(self, func, key, res):
+        """
+        Save a result, then evict the least recently used ones
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        parquet_path, pickle_path = self.paths_of(func, key)
+        
+        data = None
+        if isinstance(res, pd.DataFrame):
+            import pyarrow as pa
+            import pyarrow.parquet
+            try:
+                sink = pa.BufferOutputStream()
+                pyarrow.parquet.write_table(pa.Table.from_pandas(res), sink)
+                data = sink.getvalue().to_pybytes()
+            except (TypeError, ValueError, pa.ArrowException):
+                # e.g. interval index or object columns: saved with pickle
+                data = None
+        
+        if data is not None:
+            write_atomically(parquet_path, data)
+        else:
+            write_atomically(pickle_path, pickle.dumps(res, protocol=pickle.HIGHEST_PROTOCOL))
+        
+        self.evict()
+        return
+
+    def entries(self):
+        """
+        Return the list of (last use, size, path) of the saved results, oldest first
+        """
+        if self.directory is None or not os.path.isdir(self.directory):
+            return []
+        res = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(('.parquet', '.pkl')):
+                st = entry.stat()
+                res.append((st.st_mtime_ns, st.st_size, entry.path))
+        return sorted(res)
+
+    def evict(self):
+        """
+        Remove the least recently used results until the cache fits in max_bytes
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return
+
+    def clear(self, func = None):
+        """
+        Remove the saved results (only the ones of func, if given)
+        """
+        for _, _, path in self.entries():
+            if func is None or os.path.basename(path).startswith(func.__name__ + '-'):
+                os.remove(path)
+        return
+
+
+loader_cache = LoaderCache()
+
+
+def set_loader_cache(directory, max_bytes = 8 << 30):
+    """
+    Enable the loader cache in directory, with a disk budget of max_bytes (directory None disables it)
+    """
+    loader_cache.directory = directory
+    loader_cache.max_bytes = max_bytes
+    return loader_cache
+
+
+def cache_token(value):
+    """
+    Return a picklable token describing value for the loader cache:
+    files are described by their path and signature, dataframes by the hash of their content
+    """
+    if isinstance(value, str):
+        if os.path.isfile(value):
+            return ('file', os.path.abspath(value), file_signature(value))
+        return value
+    if isinstance(value, dict):
+        return tuple((k, cache_token(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(cache_token(v) for v in value)
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        names = value.columns if isinstance(value, pd.DataFrame) else [value.name]
+        return ('frame', hashlib.sha1(pd.util.hash_pandas_object(value).values.tobytes()).hexdigest(),
+                tuple(map(str, names)))
+    if isinstance(value, ZoneIndex):
+        return ('zones', hashlib.sha1(pickle.dumps(value.codes)).hexdigest(),
+                tuple(tuple(c) for c in value.categories.values()))
+    return value
+
+
+def disk_memoize(ignore = ('processes',)):
+    """
+    Decorator saving the results of a loader in loader_cache (when it's enabled)
+    input:
+    - ignore: names of the arguments which don't change the result
+    output:
+    - decorator; the decorated function has cache_clear() and invalidate(*args, **kwargs)
+    Generators (e.g. lazy=True) are never saved.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        
+        def key_of(args, kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = {k: v for k, v in bound.arguments.items() if k not in ignore}
+            return loader_cache.key(func, arguments)
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if loader_cache.directory is None:
+                return func(*args, **kwargs)
+            
+            key = key_of(args, kwargs)
+            found, res = loader_cache.get(func, key)
+            if found:
+                return res
+            
+            res = func(*args, **kwargs)
+            if not isinstance(res, types.GeneratorType):
+                loader_cache.put(func, key, res)
+            return res
+        
+        def invalidate(*args, **kwargs):
+            if loader_cache.directory is None:
+                return
+            for path in loader_cache.paths_of(func, key_of(args, kwargs)):
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+        
+        wrapper.cache_clear = lambda: loader_cache.clear(func)
+        wrapper.invalidate = invalidate
+        return wrapper
+    
+    return decorator
+
+
+# Zone index
+#
+# Instead of merging millions of trips with the 265 rows of taxi_zone_lookup,
+# the lookup table is turned into dense arrays indexed by LocationID
+# and every LocationID column is mapped with a single numpy take.
+
+ZONE_COLUMNS = ['Borough', 'Zone', 'service_zone']
+
+
+class ZoneIndex:
+    """
+    Dense LocationID -> Borough / Zone / service_zone lookup built from taxi_zone_lookup
+    """
+
+    def __init__(self, taxi_zone_lookup):
+        ids = taxi_zone_lookup['LocationID'].to_numpy(dtype='int64')
+        self.size = int(ids.max()) + 1
+        
+        # known[LocationID] is True for the ids in the lookup table
+        self.known = np.zeros(self.size, dtype=bool)
+        self.known[ids] = True
+        
+        # for each column: categories (sorted names) and codes[LocationID] (-1 if missing)
+        self.categories = {}
+        self.codes = {}
+        for col in ZONE_COLUMNS:
+            self.categories[col] = pd.Index(sorted(taxi_zone_lookup[col].dropna().unique()))
+            self.codes[col] = np.full(self.size, -1, dtype='int16')
+            self.codes[col][ids] = self.categories[col].get_indexer(taxi_zone_lookup[col])
+
+    def contains(self, location_ids):
+        """
+        Return a boolean array, True where the LocationID is in the lookup table
+        """
+        ids = int_codes(location_ids)
+        inside = (ids >= 0) & (ids < self.size)
+        return inside & self.known.take(np.where(inside, ids, 0))
+
+    def codes_of(self, location_ids, column = 'Borough'):
+        """
+        Return the codes (int16 array, -1 for unknown ids) of column for each LocationID
+        """
+        ids = int_codes(location_ids)
+        inside = (ids >= 0) & (ids < self.size)
+        return np.where(inside, self.codes[column].take(np.where(inside, ids, 0)), -1).astype('int16')
+
+    def lookup(self, location_ids, column = 'Borough'):
+        """
+        Return the values of column for each LocationID as a categorical
+        (NaN for ids not in the lookup table)
+        """
+        return pd.Categorical.from_codes(self.codes_of(location_ids, column), self.categories[column])
+
+
+def zone_index(taxi_zone_lookup):
+    """
+    Return a ZoneIndex for taxi_zone_lookup (which can already be a ZoneIndex)
+    """
+    if isinstance(taxi_zone_lookup, ZoneIndex):
+        return taxi_zone_lookup
+    return ZoneIndex(taxi_zone_lookup)
+
+
+# Histograms
+#
+# Compact summaries of a numeric column (durations, distances, prices...):
+# the counts in fixed bins, fed one chunk at a time and mergeable across months and boroughs.
+# Densities and KDEs are computed from the counts, never from the raw values.
+
+class Histogram:
+    """
+    Histogram with fixed bins (each bin includes its left edge)
+    """
+
+    def __init__(self, edges, counts = None):
+        """
+        input:
+        - edges: sorted edges of the bins
+        - counts: counts of the bins (DEFAULT: all 0)
+        """
+        self.edges = np.asarray(edges, dtype='float64')
+        if counts is None:
+            counts = np.zeros(len(self.edges) - 1, dtype='int64')
+        self.counts = np.asarray(counts, dtype='int64')
+
+    @classmethod
+    def linear(cls, start, stop, bins):
+        """
+        Histogram with bins of the same width between start and stop
+        """
+        return cls(np.linspace(start, stop, bins + 1))
+
+    @classmethod
+    def log(cls, start, stop, bins):
+        """
+        Histogram with logarithmic bins between start (> 0) and stop
+        """
+        return cls(np.geomspace(start, stop, bins + 1))
+
+    def update(self, values):
+        """
+        Add the values of a chunk (values outside the edges are not counted)
+        """
+        values = np.asarray(values, dtype='float64')
+        bin_of = np.searchsorted(self.edges, values, side='right') - 1
+        bin_of = bin_of[(bin_of >= 0) & (bin_of < len(self.counts))]
+        self.counts += np.bincount(bin_of, minlength=len(self.counts))
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts of another Histogram with the same edges (e.g. another month or borough)
+        """
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("histograms with different bins can't be merged")
+        self.counts = self.counts + other.counts
+        return self
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def widths(self):
+        return np.diff(self.edges)
+
+    def centers(self):
+        return (self.edges[:-1] + self.edges[1:]) / 2
+
+    def density(self):
+        """
+        Return the density of each bin (the area of the histogram is 1)
+        """
+        return self.counts / (max(self.total(), 1) * self.widths())
+
+    def labels(self):
+        """
+        Return the bins as strings '[left, right)'
+        """
+        return ['[%g, %g)' %(left, right) for left, right in zip(self.edges[:-1], self.edges[1:])]
+
+    def rebin(self, factor):
+        """
+        Return a new Histogram merging every factor consecutive bins
+        """
+        starts = np.arange(0, len(self.counts), factor)
+        edges = np.append(self.edges[starts], self.edges[-1])
+        return Histogram(edges, np.add.reduceat(self.counts, starts))
+
+    def kde(self, bandwidth = None):
+        """
+        Binned gaussian KDE: the counts are convolved (with FFT) with the gaussian kernel
+        sampled on the bins, so the cost depends on the number of bins and not on the values.
+        The bins must have the same width.
+        input:
+        - bandwidth: standard deviation of the kernel (DEFAULT: Scott's rule, as pandas' kde)
+        output:
+        - centers of the bins and the density in each of them
+        """
+        widths = self.widths()
+        if not np.allclose(widths, widths[0]):
+            raise ValueError("kde needs bins of the same width")
+        width = widths[0]
+        n = self.total()
+        
+        if bandwidth is None:
+            # Scott's rule with the mean and the std of the binned values
+            mean = (self.counts * self.centers()).sum() / max(n, 1)
+            std = np.sqrt((self.counts * (self.centers() - mean) ** 2).sum() / max(n - 1, 1))
+            bandwidth = max(std, width) * max(n, 1) ** (-1 / 5)
+        
+        # kernel on the bins' grid, up to 4 bandwidths from the center
+        half = int(min(len(self.counts), np.ceil(4 * bandwidth / width)))
+        kernel = np.exp(-0.5 * (np.arange(-half, half + 1) * width / bandwidth) ** 2)
+        
+        # linear convolution with FFT
+        size = 1 << int(np.ceil(np.log2(len(self.counts) + len(kernel) - 1)))
+        conv = np.fft.irfft(np.fft.rfft(self.counts, size) * np.fft.rfft(kernel, size), size)
+        conv = conv[half:half + len(self.counts)]
+        
+        density = np.clip(conv, 0, None) / (max(n, 1) * bandwidth * np.sqrt(2 * np.pi))
+        return self.centers(), density
+
+
+# Quantile sketches
+#
+# KLL sketches: a few hundred values (weighted 1, 2, 4, ...) summarizing any number of values
+# (at most about 3 k, with k = 200 about 180-370 for 2M values). The rank error is about 1.7 / k:
+# on 2M values, over 20 seeds, the mean absolute rank error of p50 / p90 / p99 was 0.25-0.3%
+# and the worst 0.8-1%. They are fed one chunk at a time, merged across months, boroughs
+# and zones, and saved: medians and p90 / p99 without keeping the raw durations, distances or prices.
+
+class QuantileSketch:
+    """
+    KLL quantile sketch: levels[h] holds values with weight 2**h
+    """
+
+    def __init__(self, k = 200, seed = None, levels = None, n = 0):
+        """
+        input:
+        - k: size of the biggest level, the rank error is about 1.7 / k (DEFAULT: 200)
+        - seed: seed of the random compactions (DEFAULT: None)
+        - levels, n: values of each level and number of values summarized (DEFAULT: empty)
+        """
+        self.k = k
+        self.levels = [np.asarray(level, dtype='float64') for level in levels] if levels else [np.zeros(0)]
+        self.n = int(n)
+        self.rng = np.random.default_rng(seed)
+
+    def capacity(self, h):
+        """
+        Return the number of values level h can hold (the higher levels hold more)
+        """
+        return max(int(np.ceil(self.k * (2 / 3) ** (len(self.levels) - 1 - h))), 2)
+
+    def compress(self):
+        """
+        Compact the full levels: half of their values (sorted, every other one
+        from a random start) go to the next level with double weight
+        """
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if len(level) > self.capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.zeros(0))
+                level = np.sort(level)
+                # with an odd number of values the last one stays at this level
+                odd = len(level) % 2
+                start = self.rng.integers(2)
+                promoted = level[start:len(level) - odd:2]
+                self.levels[h] = level[len(level) - odd:]
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+            h += 1
+        return self
+
+    def update(self, values):
+        """
+        Add the values of a chunk (NaN are not counted)
+        """
+        values = np.asarray(values, dtype='float64')
+        values = values[~np.isnan(values)]
+        self.n += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        return self.compress()
+
+    def merge(self, other):
+        """
+        Add the values summarized by another sketch (e.g. another month)
+        """
+        for h, level in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.zeros(0))
+            self.levels[h] = np.concatenate([self.levels[h], level])
+        self.n += other.n
+        return self.compress()
+
+    def weighted_values(self):
+        """
+        Return the values of the sketch (sorted) and their weights
+        """
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2 ** h, dtype='int64') for h, level in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        return values[order], weights[order]
+
+    def quantile(self, q):
+        """
+        Return the (approximate) q quantiles (q between 0 and 1, number or array)
+        """
+        values, weights = self.weighted_values()
+        if len(values) == 0:
+            return np.full(np.shape(q), np.nan)
+        cumulative = np.cumsum(weights)
+        i = np.searchsorted(cumulative, np.asarray(q) * cumulative[-1], side='left')
+        return values[np.clip(i, 0, len(values) - 1)]
+
+    def cdf(self, x):
+        """
+        Return the (approximate) fraction of the values <= x (number or array)
+        """
+        values, weights = self.weighted_values()
+        if len(values) == 0:
+            return np.full(np.shape(x), np.nan)
+        cumulative = np.concatenate([[0], np.cumsum(weights)])
+        return cumulative[np.searchsorted(values, x, side='right')] / cumulative[-1]
+
+    def nbytes(self):
+        return sum(level.nbytes for level in self.levels)
+
+
+class GroupedQuantiles:
+    """
+    A QuantileSketch for each group (e.g. borough or LocationID)
+    """
+
+    def __init__(self, groups, k = 200, sketches = None):
+        """
+        input:
+        - groups: names of the groups (group codes are the positions in this list)
+        - k: size of the sketches (DEFAULT: 200)
+        - sketches: a QuantileSketch for each group (DEFAULT: empty ones)
+        """
+        self.groups = list(groups)
+        self.k = k
+        if sketches is None:
+            sketches = [QuantileSketch(k, seed=g) for g in range(len(self.groups))]
+        self.sketches = sketches
+
+    def update(self, codes, values):
+        """
+        Add the values of a chunk
+        input:
+        - codes: group code of each value (-1 for values without group, not counted)
+        - values
+        """
+        codes = np.asarray(codes, dtype='int64')
+        values = np.asarray(values, dtype='float64')
+        
+        keep = (codes >= 0) & (codes < len(self.groups))
+        codes, values = codes[keep], values[keep]
+        
+        # values sorted by group: each group is a slice
+        order = np.argsort(codes, kind='stable')
+        values = values[order]
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(self.groups)))])
+        
+        for g in np.flatnonzero(np.diff(offsets)):
+            self.sketches[g].update(values[offsets[g]:offsets[g + 1]])
+        return self
+
+    def merge(self, other):
+        """
+        Add the sketches of another GroupedQuantiles with the same groups (e.g. another month)
+        """
+        if self.groups != other.groups:
+            raise ValueError("grouped quantiles with different groups can't be merged")
+        for sketch, other_sketch in zip(self.sketches, other.sketches):
+            sketch.merge(other_sketch)
+        return self
+
+    def total(self):
+        """
+        Return a QuantileSketch of all the groups together
+        """
+        res = QuantileSketch(self.k, seed=0)
+        for sketch in self.sketches:
+            res.merge(sketch)
+        return res
+
+    def table(self, quantiles = (0.5, 0.9, 0.99)):
+        """
+        Return a dataframe with 'n' and the quantiles of each group with some values
+        """
+        rows = [[sketch.n] + list(sketch.quantile(quantiles)) for sketch in self.sketches]
+        res = pd.DataFrame(rows, index=self.groups, columns=['n'] + ['p%g' %(100 * q) for q in quantiles])
+        return res[res['n'] > 0]
+
+    def save(self, path):
+        """
+        Save the sketches in a compressed .npz file
+        """
+        items = [(g, h, level) for g, sketch in enumerate(self.sketches) for h, level in enumerate(sketch.levels)]
+        np.savez_compressed(path, groups=np.array(self.groups), k=self.k,
+                            n=np.array([sketch.n for sketch in self.sketches]),
+                            item_group=np.concatenate([np.full(len(level), g) for g, _, level in items]),
+                            item_level=np.concatenate([np.full(len(level), h) for _, h, level in items]),
+                            values=np.concatenate([level for _, _, level in items]))
+        return
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load sketches saved with save
+        """
+        with np.load(path) as data:
+            groups, k = data['groups'].tolist(), int(data['k'])
+            sketches = []
+            for g in range(len(groups)):
+                mine = data['item_group'] == g
+                levels = [data['values'][mine & (data['item_level'] == h)]
+                          for h in range(data['item_level'][mine].max() + 1 if mine.any() else 1)]
+                sketches.append(QuantileSketch(k, seed=g, levels=levels, n=data['n'][g]))
+        return cls(groups, k, sketches)
+
+
+def sketch_values(chunk, attribute):
+    """
+    Return the values of attribute ('trip_duration', 'trip_distance' or 'price_per_mile')
+    of a chunk and the mask of the trips kept by the filters of RQ3, RQ5 and CQ1
+    """
+    durations = trip_durations(chunk['tpep_pickup_datetime'], chunk['tpep_dropoff_datetime'])
     
-    for i in range(len(df_names)):
+    if attribute == 'trip_duration':
+        return durations, (durations > 120) & (durations < 5400)
+    
+    distances = chunk['trip_distance'].to_numpy(dtype='float64')
+    if attribute == 'trip_distance':
+        return distances, (durations > 120) & (durations < 3600*2) & (distances > 1.2) & (distances < 50)
+    
+    if attribute == 'price_per_mile':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prices = np.round(chunk['fare_amount'].to_numpy(dtype='float64') / distances, 2)
+        return prices, (durations > 120) & (durations < 5400) & (prices > 1.5) & (prices < 30)
+    
+    raise ValueError("unknown attribute %s" %attribute)
+
+
+def quantiles_month(df_name, attribute, group, zones, k = 200, chunksize = None):
+    """
+    Return the GroupedQuantiles of attribute for the trips of a month
+    input:
+    - df_name
+    - attribute: 'trip_duration', 'trip_distance' or 'price_per_mile'
+    - group: 'Borough', 'PULocationID' or None (all the trips together)
+    - zones: ZoneIndex
+    - k: size of the sketches (DEFAULT: 200)
+    - chunksize: if given, the file is read chunksize rows at a time (DEFAULT: None)
+    """
+    if group == 'Borough':
+        res = GroupedQuantiles(zones.categories['Borough'], k)
+    elif group == 'PULocationID':
+        res = GroupedQuantiles(range(zones.size), k)
+    elif group is None:
+        res = GroupedQuantiles(['NYC'], k)
+    else:
+        raise ValueError("unknown group %s" %group)
+    
+    columns = ['tpep_pickup_datetime', 'tpep_dropoff_datetime', 'PULocationID', 'trip_distance', 'fare_amount']
+    for chunk in iter_trips(df_name, columns, chunksize):
+        values, keep = sketch_values(chunk, attribute)
+        if group == 'Borough':
+            codes = zones.codes_of(chunk['PULocationID'])
+        elif group == 'PULocationID':
+            codes = int_codes(chunk['PULocationID'])
+        else:
+            codes = np.zeros(len(chunk), dtype='int64')
+        res.update(codes[keep], values[keep])
+    return res
+
+
+@instrumented('analysis')
+def make_quantile_sketches(df_names, taxi_zone_lookup, attribute, group = 'Borough', k = 200, chunksize = None,
+                           processes = 1, aggregates = None):
+    """
+    Return the GroupedQuantiles of attribute of all the months (see quantiles_month),
+    e.g. make_quantile_sketches(df_names, lk, 'trip_duration', 'PULocationID').table() for
+    the median, p90 and p99 durations of every pickup zone
+    input:
+    - df_names
+    - taxi_zone_lookup
+    - attribute: 'trip_duration', 'trip_distance' or 'price_per_mile'
+    - group: 'Borough' (DEFAULT), 'PULocationID' or None
+    - k: size of the sketches (DEFAULT: 200)
+    - chunksize: if given, the files are read chunksize rows at a time (DEFAULT: None)
+    - processes: number of worker processes (DEFAULT: 1)
+    - aggregates: AggregateStore (or directory) with the sketches of the months already computed
+    """
+    return reduce_months(quantiles_month, df_names, attribute, group, zone_index(taxi_zone_lookup), k, chunksize,
+                         processes=processes, aggregates=aggregates)
+
+
+# Grouped statistics
+#
+# Count, mean, M2 (sum of squared deviations, Welford), min and max of some attributes
+# for every group (e.g. borough code), fed one chunk at a time and mergeable across months.
+# Means, variances and the tables of CQ1 come from these, without copies of the trips per group.
+
+class GroupedStats:
+    """
+    Count, mean, M2, min and max of some attributes for each group
+    (arrays with a row for each group and a column for each attribute)
+    """
+
+    def __init__(self, groups, attributes):
+        """
+        input:
+        - groups: names of the groups (group codes are the positions in this list)
+        - attributes: names of the attributes
+        """
+        self.groups = list(groups)
+        self.attributes = list(attributes)
+        shape = (len(self.groups), len(self.attributes))
+        self.count = np.zeros(shape, dtype='int64')
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+
+    @classmethod
+    def from_frame(cls, df, attributes, group = 'Borough', groups = None):
+        """
+        GroupedStats of the attributes of a dataframe, grouped by a column
+        (groups: names of the groups, DEFAULT: the categories / sorted values of the column)
+        """
+        column = df[group]
+        if groups is None:
+            groups = column.cat.categories if isinstance(column.dtype, pd.CategoricalDtype) else sorted(column.dropna().unique())
+        codes = pd.Index(groups).get_indexer(column)
+        return cls(groups, attributes).update(codes, df)
+
+    def update(self, codes, values):
+        """
+        Add the trips of a chunk
+        input:
+        - codes: group code of each row (-1 for rows without group, not counted)
+        - values: dataframe (or dictionary of arrays) with the attributes
+        """
+        codes = np.asarray(codes, dtype='int64')
+        n_groups = len(self.groups)
+        
+        for j, attribute in enumerate(self.attributes):
+            x = np.asarray(values[attribute], dtype='float64')
+            valid = (codes >= 0) & ~np.isnan(x)
+            chunk_codes, x = codes[valid], x[valid]
+            
+            # statistics of the chunk (mean first, then the squared deviations from it)
+            count = np.bincount(chunk_codes, minlength=n_groups)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = np.bincount(chunk_codes, x, minlength=n_groups) / count
+            deviations = x - mean[chunk_codes]
+            m2 = np.bincount(chunk_codes, deviations * deviations, minlength=n_groups)
+            
+            np.minimum.at(self.min[:, j], chunk_codes, x)
+            np.maximum.at(self.max[:, j], chunk_codes, x)
+            self._combine(j, count, np.nan_to_num(mean), m2)
+        return self
+
+    def _combine(self, j, count, mean, m2):
+        """
+        Combine the statistics of column j with count, mean, M2 of other rows (Chan et al.)
+        """
+        total = self.count[:, j] + count
+        delta = mean - self.mean[:, j]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            share = np.where(total > 0, count / total, 0)
+        self.m2[:, j] += m2 + delta * delta * self.count[:, j] * share
+        self.mean[:, j] += delta * share
+        self.count[:, j] = total
+        return
+
+    def merge(self, other):
+        """
+        Add the statistics of another GroupedStats with the same groups and attributes (e.g. another month)
+        """
+        if self.groups != other.groups or self.attributes != other.attributes:
+            raise ValueError("grouped stats with different groups or attributes can't be merged")
+        for j in range(len(self.attributes)):
+            self._combine(j, other.count[:, j], other.mean[:, j], other.m2[:, j])
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        return self
+
+    def var(self):
+        """
+        Return the sample variances (NaN for groups with less than 2 values)
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)
+
+    def std(self):
+        return np.sqrt(self.var())
+
+    def table(self, attribute):
+        """
+        Return a dataframe with 'n', 'mean', 'std', 'var', 'min', 'max' of attribute for each group
+        """
+        j = self.attributes.index(attribute)
+        empty = self.count[:, j] == 0
+        return pd.DataFrame({'n': self.count[:, j],
+                             'mean': np.where(empty, np.nan, self.mean[:, j]),
+                             'std': self.std()[:, j],
+                             'var': self.var()[:, j],
+                             'min': np.where(empty, np.nan, self.min[:, j]),
+                             'max': np.where(empty, np.nan, self.max[:, j])},
+                            index=pd.Index(self.groups, name='Borough'))
+
+
+# Contingency tables
+#
+# Counts of the trips for every pair of values of two categorical attributes (payment type and borough,
+# hour and borough, vendor and borough...). Each attribute is turned into small integer codes
+# and the pairs are counted with a single np.bincount on row_code * n_columns + column_code.
+
+class ContingencyTable:
+    """
+    Dense table of counts: counts[i, j] is the number of trips with row code i and column code j
+    """
+
+    def __init__(self, row_labels, column_labels, counts = None, row_name = None, column_name = None):
+        """
+        input:
+        - row_labels, column_labels: names of the codes (codes are the positions in these lists)
+        - counts: a (rows x columns) array of counts (DEFAULT: all 0)
+        - row_name, column_name: names of the attributes
+        """
+        self.row_labels = list(row_labels)
+        self.column_labels = list(column_labels)
+        self.row_name = row_name
+        self.column_name = column_name
+        if counts is None:
+            counts = np.zeros((len(self.row_labels), len(self.column_labels)), dtype='int64')
+        self.counts = np.asarray(counts, dtype='int64')
+
+    def update(self, row_codes, column_codes):
+        """
+        Add the trips of a chunk (codes outside the table, e.g. -1, are not counted)
+        """
+        row_codes = int_codes(row_codes)
+        column_codes = int_codes(column_codes)
+        n_rows, n_columns = self.counts.shape
+        
+        keep = (row_codes >= 0) & (row_codes < n_rows) & (column_codes >= 0) & (column_codes < n_columns)
+        counts = np.bincount(row_codes[keep] * n_columns + column_codes[keep], minlength=n_rows * n_columns)
+        
+        self.counts += counts.reshape(n_rows, n_columns)
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts of another ContingencyTable with the same labels (e.g. another month)
+        """
+        if self.row_labels != other.row_labels or self.column_labels != other.column_labels:
+            raise ValueError("contingency tables with different labels can't be merged")
+        self.counts = self.counts + other.counts
+        return self
+
+    def frame(self, drop_empty = False):
+        """
+        Return the table as a dataframe (rows and columns named with the labels)
+        - drop_empty: if True, rows and columns without trips are removed (DEFAULT: False)
+        """
+        res = pd.DataFrame(self.counts, index=pd.Index(self.row_labels, name=self.row_name),
+                           columns=pd.Index(self.column_labels, name=self.column_name))
+        if drop_empty:
+            res = res.loc[self.counts.sum(axis=1) > 0, self.counts.sum(axis=0) > 0]
+        return res
+
+
+def pickup_hours(df, zones):
+    return calendar_fields(epoch_seconds(df['tpep_pickup_datetime']))['hour']
+
+
+def pickup_weekdays(df, zones):
+    return calendar_fields(epoch_seconds(df['tpep_pickup_datetime']))['weekday']
+
+
+# attributes of the trips which can be used in a contingency table:
+# name -> (columns needed, function returning the labels from a ZoneIndex, function returning the codes of a chunk)
+# columns read only by the contingency tables (directly from the files, they aren't in the store)
+DIMENSION_DTYPES = {'VendorID': 'UInt8', 'RatecodeID': 'UInt8'}
+
+TRIP_DIMENSIONS = {
+    'payment_type': (['payment_type'], lambda zones: list(range(7)), lambda df, zones: df['payment_type']),
+    'VendorID': (['VendorID'], lambda zones: list(range(5)), lambda df, zones: df['VendorID']),
+    'RatecodeID': (['RatecodeID'], lambda zones: list(range(100)), lambda df, zones: df['RatecodeID']),
+    'passenger_count': (['passenger_count'], lambda zones: list(range(10)), lambda df, zones: df['passenger_count']),
+    'hour': (['tpep_pickup_datetime'], lambda zones: list(range(24)), pickup_hours),
+    'weekday': (['tpep_pickup_datetime'], lambda zones: list(range(7)), pickup_weekdays),
+    'Borough': (['PULocationID'], lambda zones: list(zones.categories['Borough']),
+                lambda df, zones: zones.codes_of(df['PULocationID'])),
+    'DOBorough': (['DOLocationID'], lambda zones: list(zones.categories['Borough']),
+                  lambda df, zones: zones.codes_of(df['DOLocationID'])),
+    'PULocationID': (['PULocationID'], lambda zones: list(range(zones.size)), lambda df, zones: df['PULocationID']),
+    'DOLocationID': (['DOLocationID'], lambda zones: list(range(zones.size)), lambda df, zones: df['DOLocationID']),
+}
+
 
-        df= pd.read_csv(df_names[i], parse_dates= ["tpep_pickup_datetime"])
+def contingency_month(df_name, rows, columns, zones, chunksize = None):
+    """
+    Return the ContingencyTable of the trips of a month
+    input:
+    - df_name
+    - rows, columns: names of two TRIP_DIMENSIONS
+    - zones: ZoneIndex
+    - chunksize: if given, the file is read chunksize rows at a time (DEFAULT: None)
+    """
+    row_columns, row_labels, row_codes = TRIP_DIMENSIONS[rows]
+    column_columns, column_labels, column_codes = TRIP_DIMENSIONS[columns]
+    res = ContingencyTable(row_labels(zones), column_labels(zones), row_name=rows, column_name=columns)
+    
+    needed = list(dict.fromkeys(row_columns + column_columns))
+    for chunk in iter_trips(df_name, needed, chunksize, dtypes=DIMENSION_DTYPES):
+        res.update(row_codes(chunk, zones), column_codes(chunk, zones))
+    return res
+
+
+@instrumented('analysis')
+def make_contingency_table(df_names, taxi_zone_lookup, rows, columns, chunksize = None, processes = 1,
+                           aggregates = None):
+    """
+    Return the ContingencyTable of two attributes of the trips of all the months
+    input:
+    - df_names
+    - taxi_zone_lookup
+    - rows, columns: names of two TRIP_DIMENSIONS (e.g. 'payment_type' and 'Borough', 'hour' and 'Borough')
+    - chunksize: if given, the files are read chunksize rows at a time (DEFAULT: None)
+    - processes: number of worker processes counting the months (DEFAULT: 1)
+    - aggregates: AggregateStore (or directory) with the tables of the months already counted
+    """
+    return reduce_months(contingency_month, df_names, rows, columns, zone_index(taxi_zone_lookup), chunksize,
+                         processes=processes, aggregates=aggregates)
+
+
+# Partitioned frames
+#
+# The trips sorted by borough (stable sort on the borough codes) with the offsets of each borough:
+# the trips of a borough are a contiguous slice of the frame, taken without a boolean mask
+# over all the trips and without copying them.
+
+class PartitionedFrame:
+    """
+    Dataframe sorted by the codes of a column, with the offsets of each group
+    """
+
+    def __init__(self, frame, groups, offsets, column = 'Borough'):
+        """
+        input:
+        - frame: dataframe sorted by group (rows without group at the end)
+        - groups: names of the groups
+        - offsets: the rows of groups[i] are frame[offsets[i]:offsets[i+1]]
+        - column: name of the column of the groups
+        """
+        self.frame = frame
+        self.groups = pd.Index(groups)
+        self.offsets = np.asarray(offsets, dtype='int64')
+        self.column = column
+
+    @classmethod
+    def from_frame(cls, df, column = 'Borough', groups = None):
+        """
+        Sort a dataframe by column (keeping the order of the rows inside each group)
+        input:
+        - dataframe
+        - column (DEFAULT: 'Borough')
+        - groups: names of the groups (DEFAULT: the categories / sorted values of the column)
+        """
+        values = df[column]
+        if groups is None:
+            groups = values.cat.categories if isinstance(values.dtype, pd.CategoricalDtype) else sorted(values.dropna().unique())
+        groups = pd.Index(groups)
+        
+        # rows without group get the code len(groups), so they go after all the groups
+        codes = groups.get_indexer(values)
+        codes[codes < 0] = len(groups)
+        codes = codes.astype('int8' if len(groups) < 127 else 'int32')
+        
+        order = np.argsort(codes, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(groups) + 1))])
+        return cls(df.take(order), groups, offsets[:len(groups) + 1], column)
+
+    def __len__(self):
+        return len(self.frame)
+
+    def __getitem__(self, group):
+        """
+        Return the rows of a group (a slice of frame, not a copy)
+        """
+        i = self.groups.get_loc(group)
+        return self.frame.iloc[self.offsets[i]:self.offsets[i + 1]]
+
+    def sizes(self):
+        """
+        Return the number of rows of each group
+        """
+        return pd.Series(np.diff(self.offsets), index=self.groups)
+
+    def items(self):
+        for group in self.groups:
+            yield group, self[group]
+
+
+def group_rows (df, group, column = 'Borough'):
+    """
+    Return the rows of df with column == group: a slice if df is a PartitionedFrame, otherwise a filtered copy
+    """
+    if isinstance(df, PartitionedFrame):
+        return df[group]
+    return df[df[column] == group]
+
+
+def partition_months (res, lazy, partition):
+    """
+    Partition by borough the result of a loader (all the months or, if lazy, each month)
+    """
+    if not partition:
+        return res
+    if lazy:
+        return (PartitionedFrame.from_frame(month) for month in res)
+    return PartitionedFrame.from_frame(res)
+
+
+# Data quality report
+#
+# All the counters of a month (payment types, zero and negative amounts, trips out of the month,
+# missing values, min and max of each column...) computed in one pass over each chunk,
+# without filtered copies of the trips. Reports of chunks and months are merged.
+
+# columns whose values are counted (values from 0 to size - 1, the others are counted as 'other')
+QUALITY_CATEGORIES = {'payment_type': 7, 'VendorID': 5, 'RatecodeID': 100, 'passenger_count': 10}
+
+# valid range of the location ids
+QUALITY_RANGES = {'PULocationID': (1, 265), 'DOLocationID': (1, 265)}
+
+
+def file_columns(df_name):
+    """
+    Return the names of the columns of a month file (csv, parquet or feather) without reading it
+    """
+    file_format = trips_format(df_name)
+    if file_format == 'csv':
+        return list(pd.read_csv(df_name, nrows=0).columns)
+    
+    import pyarrow.ipc
+    import pyarrow.parquet
+    
+    if file_format == 'parquet':
+        return pyarrow.parquet.read_schema(df_name).names
+    return pyarrow.ipc.open_file(df_name).schema.names
+
+
+class QualityReport:
+    """
+    Data quality counters of the trips of a month
+    """
+
+    def __init__(self, year = None, month = None):
+        """
+        input:
+        - year, month of the file: the trips with pickup in another month are counted
+          as 'out of month' (DEFAULT: None, not checked)
+        """
+        self.year = year
+        self.month = month
+        self.counters = defaultdict(int)
+        self.nulls = defaultdict(int)
+        self.min = {}
+        self.max = {}
+        self.categories = {}
+
+    def update(self, df):
+        """
+        Add the trips of a chunk (any of the TRIP_COLUMNS, with compact, nullable or float dtypes)
+        """
+        self.counters['rows'] += len(df)
+        
+        for col in df.columns:
+            values = df[col]
+            self.nulls[col] += int(values.isna().sum())
+            if len(values) > values.isna().sum():
+                low, high = values.min(), values.max()
+                self.min[col] = low if col not in self.min else min(self.min[col], low)
+                self.max[col] = high if col not in self.max else max(self.max[col], high)
+        
+        # codes outside 0..size-1 (or not integer) are counted as 'other'
+        for col, size in QUALITY_CATEGORIES.items():
+            if col in df.columns:
+                codes = df[col].to_numpy(dtype='float64', na_value=np.nan)
+                codes = codes[~np.isnan(codes)]
+                inside = (codes >= 0) & (codes < size) & (codes == np.floor(codes))
+                counts = np.append(np.bincount(codes[inside].astype('int64'), minlength=size), (~inside).sum())
+                self.categories[col] = self.categories.get(col, 0) + counts
+        
+        for col, (low, high) in QUALITY_RANGES.items():
+            if col in df.columns:
+                ids = df[col].to_numpy(dtype='float64', na_value=np.nan)
+                ids = ids[~np.isnan(ids)]
+                outside = (ids < low) | (ids > high) | (ids != np.floor(ids))
+                self.counters['%s out of range' %col] += int(outside.sum())
+        
+        # zero and negative amounts
+        zero = {}
+        for col in ['fare_amount', 'total_amount', 'trip_distance']:
+            if col in df.columns:
+                values = df[col].to_numpy(dtype='float64')
+                zero[col] = values == 0
+                self.counters['%s == 0' %col] += int(zero[col].sum())
+                self.counters['%s < 0' %col] += int((values < 0).sum())
+        
+        if 'fare_amount' in zero and 'total_amount' in zero:
+            self.counters['fare_amount == 0 and total_amount == 0'] += int((zero['fare_amount'] & zero['total_amount']).sum())
+            self.counters['fare_amount == 0 or total_amount == 0'] += int((zero['fare_amount'] | zero['total_amount']).sum())
+        
+        # timestamps
+        if 'tpep_pickup_datetime' in df.columns:
+            pickup = df['tpep_pickup_datetime']
+            if self.year is not None:
+                fields = calendar_fields(epoch_seconds(pickup))
+                out = (fields['year'] != self.year) | (fields['month'] != self.month)
+                self.counters['out of month'] += int((out & pickup.notna().to_numpy()).sum())
+            if 'tpep_dropoff_datetime' in df.columns:
+                dropoff = df['tpep_dropoff_datetime']
+                durations = trip_durations(pickup, dropoff)
+                known = (pickup.notna() & dropoff.notna()).to_numpy()
+                self.counters['dropoff before pickup'] += int(((durations < 0) & known).sum())
+        return self
 
+    def merge(self, other):
+        """
+        Add the counters of another report (e.g. another chunk or month)
+        """
+        for name, value in other.counters.items():
+            self.counters[name] += value
+        for col, value in other.nulls.items():
+            self.nulls[col] += value
+        for col, value in other.min.items():
+            self.min[col] = value if col not in self.min else min(self.min[col], value)
+        for col, value in other.max.items():
+            self.max[col] = value if col not in self.max else max(self.max[col], value)
+        for col, counts in other.categories.items():
+            self.categories[col] = self.categories.get(col, 0) + counts
+        if (self.year, self.month) != (other.year, other.month):
+            self.year = self.month = None
+        return self
 
-        print ("mese %s" %str(i+1))
-        print ("\tpayment_types     :",
-               "[1:", str(df[df["payment_type"]== 1].shape[0]) + "]", "[2:", str(df[df["payment_type"]== 2].shape[0]) + "]",
-               "[3:", str(df[df["payment_type"]== 3].shape[0]) + "]", "[4:", str(df[df["payment_type"]== 4].shape[0]) + "]",
-               "[5:", str(df[df["payment_type"]== 5].shape[0]) + "]", "[6:", str(df[df["payment_type"]== 6].shape[0]) + "]"
-              )
+    def summary(self):
+        """
+        Return the report as a series: counters (including '<column> out of range' for the location ids),
+        '<column>=<value>' counts ('<column>=other' for the codes out of range), 'null rate <column>',
+        'min <column>', 'max <column>'
+        """
+        res = dict(self.counters)
+        for col, counts in self.categories.items():
+            for value, count in enumerate(counts[:-1]):
+                if count > 0:
+                    res['%s=%d' %(col, value)] = int(count)
+            res['%s=other' %col] = int(counts[-1])
+        rows = max(self.counters['rows'], 1)
+        for col, nulls in self.nulls.items():
+            res['null rate %s' %col] = nulls / rows
+        for col in self.min:
+            res['min %s' %col] = self.min[col]
+            res['max %s' %col] = self.max[col]
+        return pd.Series(res, dtype=object)
 
 
+def iter_raw_trips(df_name, columns, chunksize = None):
+    """
+    Same of iter_trips, but the columns of csv files are read with the dtypes inferred by pandas
+    instead of TRIP_DTYPES: integer columns with missing or wrong values (NaN, -1, 300 passengers...)
+    become floats, and timestamps which can't be parsed become NaT, so they can be counted.
+    Binary files were written with compact_trips and are read with iter_trips.
+    """
+    if trips_format(df_name) != 'csv':
+        yield from iter_trips(df_name, columns, chunksize, dtypes=DIMENSION_DTYPES)
+        return
+    
+    chunks = pd.read_csv(df_name, usecols=columns, chunksize=chunksize)
+    for chunk in ([chunks] if chunksize is None else chunks):
+        for col in DATETIME_COLUMNS:
+            if col in chunk.columns:
+                try:
+                    seconds = tlc_seconds(chunk[col])
+                    chunk[col] = pd.to_datetime(seconds, unit='s')
+                except (ValueError, TypeError):
+                    chunk[col] = pd.to_datetime(chunk[col], format=TLC_DATETIME_FORMAT, errors='coerce')
+        yield chunk[columns]
+    return
 
-        print("\ttotal_amount == 0 : %i" %df[df["total_amount"] == 0].shape[0])
-        print ("\tfare_amount == 0  :",df[df["fare_amount"]== 0].shape[0])
-        print("\ttrip_distance == 0:",df[df["trip_distance"]== 0].shape[0])
 
-        print("\tfare_amount == 0 and total_amount == 0 -->",
-              df[(df["total_amount"] ==0) & (df["fare_amount"]==0)].shape[0])
+def quality_report_month(df_name, year, month = None, chunksize = None):
+    """
+    Return the QualityReport of a month
+    input:
+    - df_name
+    - year, month: year and month of the file if its name doesn't contain them ('..._2018-01.csv')
+    - chunksize: if given, the file is read chunksize rows at a time (DEFAULT: None)
+    The arguments describe only this month, so its report saved in an AggregateStore
+    is found again when other months are added.
+    """
+    year, month = year_and_month(df_name, (year, month))
+    columns = [col for col in TRIP_COLUMNS + list(DIMENSION_DTYPES) if col in file_columns(df_name)]
+    
+    res = QualityReport(year, month)
+    for chunk in iter_raw_trips(df_name, columns, chunksize):
+        with stage('quality', rows_in=len(chunk), df_name=df_name):
+            res.update(chunk)
+    return res
 
-        print("\tfare_amount == 0 or total_amount == 0 -->",
-              df[(df["fare_amount"]==0) | (df["total_amount"] ==0)].shape[0])
 
-        print("\tboth year and month different -->",
-              df[(df['tpep_pickup_datetime'].dt.year != 2018) | (df['tpep_pickup_datetime'].dt.month != i+1)].shape[0] )
-    return
+# Function that provides some informations about the different csv files
+@instrumented('analysis')
+def stats(df_names, year = 2018, chunksize = None, processes = 1, aggregates = None):
+    """
+    Data quality report of the months
+    input:
+    - df_names
+    - year: year of the files whose name doesn't contain it (the month is the position in df_names)
+    - chunksize: if given, the files are read chunksize rows at a time (DEFAULT: None)
+    - processes: number of worker processes (DEFAULT: 1)
+    - aggregates: AggregateStore (or directory) with the reports of the months already computed
+    output:
+    - dataframe with a row for every month and one for all of them ('all'),
+      a column for every counter (see QualityReport.summary)
+    """
+    # the months whose name contains the date are computed together, the others one at a time
+    # with the month given by their position
+    dated = [df_name for df_name in df_names if year_and_month(df_name, None) is not None]
+    reports = dict(zip(dated, map_months(quality_report_month, dated, year, None, chunksize,
+                                         processes=processes, aggregates=aggregates)))
+    for i, df_name in enumerate(df_names):
+        if df_name not in reports:
+            reports[df_name] = map_months(quality_report_month, [df_name], year, i+1, chunksize,
+                                          aggregates=aggregates)[0]
+    reports = [reports[df_name] for df_name in df_names]
+    
+    rows = [report.summary() for report in reports]
+    total = QualityReport()
+    for report in reports:
+        total.merge(report)
+    # merge changes the first report, so the total is computed on a new one
+    rows.append(total.summary())
+    
+    res = pd.DataFrame(rows, index=list(df_names) + ['all'])
+    counts = [col for col in res.columns if not col.startswith(('null rate ', 'min ', 'max '))]
+    res[counts] = res[counts].fillna(0).astype('int64')
+    return res
 
 # RQ1 functions
 
-def clean_dataframe(df, month):
+def clean_dataframe(df, month, year = 2018):
     """
     Clean the dataframe, removing wrong dates and wrong taxy's trips
     input:
-    - dataframe
+    - dataframe (or a chunk of it)
     - month which correspond the dataframe
-    output:from scipy.stats import chi2_contingency, ttest_ind ,chisquare, kruskal, pearsonr
+    - year which correspond the dataframe (DEFAULT: 2018)
+    output:
     - cleaned dataframe
     """
     
-    #removing years different from 2018 and months different from ith month
-    df = df[(df['tpep_pickup_datetime'].dt.year == 2018) & (df['tpep_pickup_datetime'].dt.month == month)]
-        
-    # removing races with total_amount > 0
-    df = df[(df['total_amount'] > 0)]
+    with stage('filter', rows_in=len(df), function='clean_dataframe') as st:
+        #removing years different from year and months different from ith month
+        # (the pickup datetimes can be datetimes or the strings of the file)
+        fields = calendar_fields(tlc_seconds(df['tpep_pickup_datetime']))
+        df = df[(fields['year'] == year) & (fields['month'] == month)]
+            
+        # removing races with total_amount > 0
+        df = df[(df['total_amount'] > 0)]
+        st.rows(len(df))
 
     return df
 
 
-def make_new_csv (df_names):
+def year_and_month(df_name, default):
+    """
+    Return (year, month) of a TLC file from its name ('..._2018-01.csv'),
+    or default if the name doesn't contain them
+    """
+    match = re.search(r'(\d{4})-(\d{2})', os.path.basename(df_name))
+    if match is None:
+        return default
+    return int(match.group(1)), int(match.group(2))
+
+
+def clean_month_file(old_name, new_name, month, year = 2018, file_format = 'csv', chunksize = None):
+    """
+    Clean a raw month file and write the cleaned one
+    input:
+    - path of the raw csv file
+    - path of the new file
+    - month and year which correspond the file
+    - file_format: 'csv', 'parquet' or 'feather'
+    - chunksize: if given, the raw file is read and cleaned chunksize rows at a time,
+      so only one chunk is in memory (DEFAULT: None, the whole file)
+    output:
+    - path of the new file
+    """
+    
+    # the known columns are read with RAW_DTYPES, so all the chunks have the same dtypes
+    if chunksize is None:
+        df = pd.read_csv(old_name, dtype=RAW_DTYPES)
+        chunks = [clean_dataframe(df, month, year)]
+    else:
+        # lazy generator: every chunk is cleaned and written before reading the next one
+        chunks = (clean_dataframe(chunk, month, year)
+                  for chunk in pd.read_csv(old_name, dtype=RAW_DTYPES, chunksize=chunksize))
+    
+    with stage('write', df_name=new_name, format=file_format):
+        if file_format == 'csv':
+            # the chunks keep the row numbers of the raw file, as the whole dataframe does
+            for j, chunk in enumerate(chunks):
+                chunk.to_csv(new_name, mode = 'w' if j == 0 else 'a', header = (j == 0))
+        else:
+            write_trips_chunks(chunks, new_name, file_format)
+    
+    return new_name
+
+
+@instrumented('analysis')
+def make_new_csv (df_names, file_format = 'csv', chunksize = None, processes = 1, df_old_names = None):
     """
     Make new csv files after cleaning each datasets
     input:
     - dataframe names' paths
+    - file_format: 'csv' (DEFAULT), or 'parquet' / 'feather' to write each month
+      as a binary file with compact dtypes (the extension of the name is replaced)
+    - chunksize: number of rows cleaned at a time (DEFAULT: None, whole months)
+    - processes: number of worker processes cleaning months in parallel (DEFAULT: 1)
+    - df_old_names: raw files' paths (DEFAULT: January-June 2018 in old_data/),
+      year and month of each file are taken from its name
+    output:
+    - list of the written files' paths
     """
 
-    df_old_names =['old_data/yellow_tripdata_2018-01.csv','old_data/yellow_tripdata_2018-02.csv',
-                   'old_data/yellow_tripdata_2018-03.csv','old_data/yellow_tripdata_2018-04.csv',
-                   'old_data/yellow_tripdata_2018-05.csv','old_data/yellow_tripdata_2018-06.csv']
+    if df_old_names is None:
+        df_old_names =['old_data/yellow_tripdata_2018-01.csv','old_data/yellow_tripdata_2018-02.csv',
+                       'old_data/yellow_tripdata_2018-03.csv','old_data/yellow_tripdata_2018-04.csv',
+                       'old_data/yellow_tripdata_2018-05.csv','old_data/yellow_tripdata_2018-06.csv']
+
+    if file_format != 'csv' and file_format not in BINARY_FORMATS:
+        raise ValueError("unknown file format %s" %file_format)
+
+    # arguments of clean_month_file for every month
+    jobs = []
 
     for i in range(len(df_names)):
-        df = pd.read_csv(df_old_names[i], parse_dates= ["tpep_pickup_datetime"])
-        # cleaning function
-        df = clean_dataframe(df,i+1)
-        df.to_csv(df_names[i])
+        year, month = year_and_month(df_old_names[i], (2018, i+1))
+        
+        if file_format == 'csv':
+            new_name = df_names[i]
+        else:
+            new_name = os.path.splitext(df_names[i])[0] + BINARY_FORMATS[file_format]
+        
+        jobs.append((df_old_names[i], new_name, month, year, file_format, chunksize))
+
+    if processes == 1:
+        return [clean_month_file(*job) for job in jobs]
+
+    # the events of the workers are given to the sinks of this process
+    forward = bool(_event_sinks)
+    kernel = ForwardingKernel(clean_month_file) if forward else clean_month_file
+    
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(kernel, *job) for job in jobs]
+        return [forwarded(future.result()) if forward else future.result() for future in futures]
+
+
+def epoch_days(datetimes):
+    """
+    Return the days since 1970-01-01 (int64 array) of a datetime column
+    """
+    return np.asarray(datetimes, dtype='datetime64[D]').astype('int64')
+
+
+def epoch_seconds(datetimes):
+    """
+    Return the seconds since 1970-01-01 (int64 array) of a datetime column
+    """
+    return np.asarray(datetimes, dtype='datetime64[s]').astype('int64')
 
-    return
 
+def trip_durations(pickup_datetimes, dropoff_datetimes):
+    """
+    Return the duration in seconds (int64 array) of each trip
+    """
+    return epoch_seconds(dropoff_datetimes) - epoch_seconds(pickup_datetimes)
+
+
+def month_daily_averages(per_day):
+    """
+    Compute the average trips per day of each month, over all the calendar days of the month
+    input:
+    - series (or dataframe) of trips indexed by day
+    output:
+    - the same indexed by month (pandas Period)
+    """
+    per_month = per_day.groupby(per_day.index.to_period('M')).sum()
+    days = np.asarray(per_month.index.days_in_month)
+    
+    if isinstance(per_month, pd.DataFrame):
+        return per_month.floordiv(days, axis=0)
+    return per_month // days
+
+
+def main_month(per_day):
+    """
+    Return the month (pandas Period) with more trips, i.e. the month of a cleaned file
+    input:
+    - series (or dataframe) of trips indexed by day
+    """
+    if isinstance(per_day, pd.DataFrame):
+        per_day = per_day.sum(axis=1)
+    return per_day.groupby(per_day.index.to_period('M')).sum().idxmax()
+
+
+class TripsPerDay:
+    """
+    Counter of the trips per day, fed one chunk at a time.
+    It keeps only one value per day, so it can count any range of dates.
+    """
+
+    def __init__(self):
+        # days since 1970-01-01 -> number of trips
+        self.counts = defaultdict(int)
+
+    def update(self, pickup_datetimes):
+        """
+        Add the trips of a chunk
+        input:
+        - tpep_pickup_datetime column of the chunk
+        """
+        days, counts = np.unique(epoch_days(pickup_datetimes), return_counts=True)
+        for day, count in zip(days.tolist(), counts.tolist()):
+            self.counts[day] += count
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts of another TripsPerDay (e.g. another month)
+        """
+        for day, count in other.counts.items():
+            self.counts[day] += count
+        return self
+
+    def per_day(self):
+        """
+        Return a series with the number of trips for each day
+        """
+        days = sorted(self.counts)
+        return pd.Series([self.counts[day] for day in days],
+                         index=pd.DatetimeIndex(np.array(days, dtype='datetime64[D]')), name='trips')
+
+    def daily_averages(self):
+        """
+        Return a series with the average trips per day for each month
+        """
+        return month_daily_averages(self.per_day())
 
 
-def compute_daily_average (df_names):
+class BoroughTripsPerDay:
+    """
+    Counter of the trips per day for each pickup borough, fed one chunk at a time.
+    It keeps one value for each (day, zone), so memory is O(zones x days).
+    """
+
+    def __init__(self, taxi_zone_lookup):
+        # LocationID -> Borough
+        self.zones = zone_index(taxi_zone_lookup)
+        # day * 65536 + LocationID -> number of trips
+        self.counts = defaultdict(int)
+
+    def update(self, pickup_datetimes, location_ids):
+        """
+        Add the trips of a chunk
+        input:
+        - tpep_pickup_datetime column of the chunk
+        - PULocationID column of the chunk
+        """
+        keys = epoch_days(pickup_datetimes) * 65536 + int_codes(location_ids)
+        keys, counts = np.unique(keys, return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.counts[key] += count
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts of another BoroughTripsPerDay (e.g. another month)
+        """
+        for key, count in other.counts.items():
+            self.counts[key] += count
+        return self
+
+    def per_day(self):
+        """
+        Return a dataframe with the number of trips for each day (rows) and borough (columns)
+        """
+        keys = np.array(list(self.counts), dtype='int64')
+        
+        temp = pd.DataFrame({'day': keys // 65536, 'LocationID': keys % 65536,
+                             'trips': np.array(list(self.counts.values()), dtype='int64')})
+        temp['Borough'] = self.zones.lookup(temp['LocationID'])
+        
+        temp = temp.groupby(['day', 'Borough'], observed=True)['trips'].sum().unstack(fill_value=0)
+        temp.index = pd.DatetimeIndex(temp.index.values.astype('datetime64[D]'))
+        temp.columns.name = None
+        return temp
+
+    def daily_averages(self):
+        """
+        Return a dataframe with the average trips per day for each month (rows) and borough (columns)
+        """
+        return month_daily_averages(self.per_day())
+
+
+def trips_per_day_month (df_name, chunksize = None):
+    """
+    Return the TripsPerDay of a month file
+    """
+    counter = TripsPerDay()
+    for chunk in iter_trips(df_name, ['tpep_pickup_datetime'], chunksize):
+        counter.update(chunk['tpep_pickup_datetime'])
+    return counter
+
+
+def borough_trips_per_day_month (df_name, zones, chunksize = None):
+    """
+    Return the BoroughTripsPerDay of a month file
+    """
+    counter = BoroughTripsPerDay(zones)
+    for chunk in iter_trips(df_name, ['tpep_pickup_datetime', 'PULocationID'], chunksize):
+        counter.update(chunk['tpep_pickup_datetime'], chunk['PULocationID'])
+    return counter
+
+
+@instrumented('analysis')
+def compute_daily_average (df_names, chunksize = None, processes = 1, aggregates = None):
     """
     Compute the average number of trips recorded each day
     input:
     - list of names of csv file to open
+    - chunksize: if given, each file is streamed chunksize rows at a time (DEFAULT: None)
+    - processes: number of worker processes counting the months (DEFAULT: 1)
+    - aggregates: AggregateStore (or directory) with the counters of the months already counted
     output:
     - list of the daily average trips per each month
     """
@@ -96,23 +2520,28 @@ def compute_daily_average (df_names):
     # init the daily average list
     daily_average_lst = []
     
-    for i in range(len(df_names)):
-        # load the ith dataframe, taking only the t_pickup_datetime and total_amount columns
-        df = pd.read_csv(df_names[i], usecols= ['tpep_pickup_datetime', 'total_amount'],
-                         parse_dates= ["tpep_pickup_datetime"])
+    # counters of the trips per day of every file
+    for counter in imap_months(trips_per_day_month, df_names, chunksize, processes=processes,
+                               aggregates=aggregates):
         
-        # appending the average computed as the len of the dataframe / the last day of the month
-        daily_average_lst.append(df.shape[0] // df["tpep_pickup_datetime"].iloc[-1].day)
+        # the month of the file is the one with more trips,
+        # its average is computed over the calendar days of that month
+        per_day = counter.per_day()
+        daily_average_lst.append(int(month_daily_averages(per_day)[main_month(per_day)]))
     
     return daily_average_lst
 
 
-def compute_borough_averages (df_names, taxi_zone_lookup):
+@instrumented('analysis')
+def compute_borough_averages (df_names, taxi_zone_lookup, chunksize = None, processes = 1, aggregates = None):
     """
     compute the daily averages for each month for each borough
     input:
     - list of names of csv file to open
     - taxi_zone_lookup table
+    - chunksize: if given, each file is streamed chunksize rows at a time (DEFAULT: None)
+    - processes: number of worker processes counting the months (DEFAULT: 1)
+    - aggregates: AggregateStore (or directory) with the counters of the months already counted
     output:
     - dictionary which contains for each borow the list of daily averages for each month
     """
@@ -122,53 +2551,45 @@ def compute_borough_averages (df_names, taxi_zone_lookup):
     # values: each value contains a list with daily average for each month for its key (borough)
     borough_averages = defaultdict(list)
     
-    # defining the days for each month (to compute the average)
-    month_days = [31, 28, 31, 30, 31, 30]
+    zones = zone_index(taxi_zone_lookup)
     
-    for i in range(len(df_names)):
-
-        df = pd.read_csv(df_names[i], usecols= ['tpep_pickup_datetime', 'total_amount', 'PULocationID'],
-                         parse_dates= ["tpep_pickup_datetime"])
-
-        # dropping out the colums not needed anymore
-        df.drop(['tpep_pickup_datetime', 'total_amount'], axis = 1, inplace= True)
+    for counter in imap_months(borough_trips_per_day_month, df_names, zones, chunksize, processes=processes,
+                               aggregates=aggregates):
 
-        # merging PULocationID with taxi_zone_lookup table
-        df = pd.merge(df, taxi_zone_lookup, how = 'left', left_on = 'PULocationID', right_on = 'LocationID')
-
-        # dropping out other columns don't needed
-        df.drop(['PULocationID', 'Zone', 'service_zone'], axis = 1, inplace = True)
-
-        # grouping by Borough (indexing by Borough)
-        # so we have only one column containing for each borough the total number of trips
-        df = df.groupby("Borough").count()
+        # averages for each month (rows) and borough (columns),
+        # we keep the month of the file (the one with more trips)
+        per_day = counter.per_day()
+        averages = month_daily_averages(per_day)
+        month = main_month(per_day)
         
-        # removing unknown dataframe
-        df = df[df.index != 'Unknown']
+        # removing unknown borough
+        averages = averages.drop(columns='Unknown', errors='ignore')
         
-        # for every index (key), compute the average and add it on the dictionary
-        for key in df.index:
-            borough_averages[key].append(int(df.loc[key][0]) // month_days[i])
+        # for every borough (key), add the average on the dictionary
+        for key in averages.columns:
+            borough_averages[key].append(int(averages.loc[month, key]))
 
     return borough_averages
 
+@instrumented('plot')
 def plot_daily_averages(daily_average_lst, months):
     """
     plots the daily average list
     """
     # plot daily_average_lst
     f = plt.figure()
-    plt.xticks(range(1,7),months)
+    plt.xticks(range(1,len(daily_average_lst)+1),months)
     plt.ylabel("daily_average")
     plt.xlabel("months")
     plt.title("Daily average for each month in NYC")
-    plt.plot(range(1,7), daily_average_lst, '-o', markersize=13, color='royalblue')
+    plt.plot(range(1,len(daily_average_lst)+1), daily_average_lst, '-o', markersize=13, color='royalblue')
     plt.grid(color ='lightgray', linestyle = '-.')
     f.set_figwidth(14)
     f.set_figheight(5)
 
     return
 
+@instrumented('plot')
 def plot_boroug_averages(borough_averages, months):
     """
     Plot all the daily average for each borought
@@ -234,33 +2655,75 @@ def plot_boroug_averages(borough_averages, months):
     return
 ##RQ2
 
-def passengers_NY_all_months (df_names):
+def passengers_NY_month (df_name):
+    """
+        Returns the dataframe of a month with the colums:
+        tpep_pickup_datetime, passenger_count, PULocationID
+        """
+    return load_trips(df_name, ['tpep_pickup_datetime', 'passenger_count', 'PULocationID'])
+
+
+@instrumented('analysis')
+@disk_memoize()
+def passengers_NY_all_months (df_names, lazy = False, processes = 1):
     """
         Returns the dataframe with two colums:
         tpep_pickup_datetime, passenger_count
+        (lazy = True returns a generator of the months' dataframes,
+        processes > 1 loads the months in worker processes)
+        """
+    return load_months(passengers_NY_month, df_names, lazy=lazy, processes=processes)
+
+
+def hourly_passengers_month (df_name, zones):
+    """
+        Returns the passengers of a month for each hour (rows) and pickup borough (columns)
         """
-    df = pd.DataFrame()
+    df = load_trips(df_name, ['tpep_pickup_datetime', 'passenger_count', 'PULocationID'])
     
-    for i in range (len(df_names)):
-        temp = pd.read_csv(df_names[i], usecols= ['tpep_pickup_datetime', 'passenger_count', 'PULocationID'],
-                           parse_dates= ["tpep_pickup_datetime"])
-                           
-        df = df.append(temp)
+    hours = calendar_fields(epoch_seconds(df['tpep_pickup_datetime']))['hour']
     
-    return df
+    with stage('groupby', rows_in=len(df), function='hourly_passengers_month', df_name=df_name) as st:
+        res = df['passenger_count'].fillna(0).astype('int64').groupby(
+            [hours, zones.lookup(df['PULocationID'])], observed=True).sum().unstack(fill_value=0)
+        st.rows(len(res))
+    return res
+
+
+@instrumented('analysis')
+def passengers_per_hour (df_names, taxi_zone_lookup, processes = 1, aggregates = None):
+    """
+        Returns the dataframe with the passengers for each hour (rows, 0-23)
+        and pickup borough (columns) of all the months
+        input:
+        - df_names
+        - taxi_zone_lookup
+        - processes: number of worker processes counting the months (DEFAULT: 1)
+        - aggregates: AggregateStore (or directory) with the tables of the months already counted
+        """
+    res = reduce_months(hourly_passengers_month, df_names, zone_index(taxi_zone_lookup),
+                        processes=processes, aggregates=aggregates)
+    return res.fillna(0).astype('int64')
 
 
+@instrumented('plot')
 def plot_NY_24_hours(df):
     """
     plot the hourly number of passengers for whole NY city
+    input:
+    - df of passengers_NY_all_months, or the table of passengers_per_hour
     """
     
-    # A new temp dataframe with df without 'PULocationID' column
-    temp = df.drop('PULocationID',axis=1)
-    
-    # Using the 'tpep_pickup_datetime' as index and groupying by index.hour
-    temp.set_index("tpep_pickup_datetime",inplace=True)
-    temp = temp.groupby(temp.index.hour).sum()
+    if 'tpep_pickup_datetime' in df.columns:
+        # A new temp dataframe with df without 'PULocationID' column
+        temp = df.drop('PULocationID',axis=1)
+        
+        # Using the 'tpep_pickup_datetime' as index and groupying by index.hour
+        temp.set_index("tpep_pickup_datetime",inplace=True)
+        temp = temp.groupby(temp.index.hour).sum()
+    else:
+        # passengers per hour of all the boroughs
+        temp = df.sum(axis=1).to_frame('passenger_count')
     
     # plotting the df
     f = plt.figure()
@@ -297,28 +2760,104 @@ def time_slots(x):
 
 
 
-def time_slots_and_plot (df, color):
+class TimeSlots:
+    """
+    Definition of the time slots of a day, compiled to a lookup table
+    from the time of the day (in steps of `step` minutes) to the slot.
+    A slot starts at its start time and lasts until the next one,
+    the last slot lasts until the first start of the next day (e.g. '20-01').
+    """
+
+    def __init__(self, starts, labels = None, step = None):
+        """
+        input:
+        - starts: sorted start times of the slots, in hours of the day (e.g. [1, 6, 12, 17, 20], 7.5 is 07:30)
+        - labels: names of the slots (DEFAULT: 'start-end', e.g. '01-06')
+        - step: resolution in minutes of the lookup table, it must divide a day and every start time
+          (DEFAULT: the largest one dividing an hour, 60 - a 24 entries table - for slots at o'clock)
+        """
+        minutes = [int(round(start * 60)) % 1440 for start in starts]
+        
+        if step is None:
+            step = math.gcd(60, *minutes)
+        
+        if 1440 % step != 0 or any(m % step != 0 for m in minutes):
+            raise ValueError("step must divide 1440 and every start time")
+        if minutes != sorted(set(minutes)):
+            raise ValueError("start times must be sorted and different")
+        
+        if labels is None:
+            ends = minutes[1:] + minutes[:1]
+            labels = [self.format_time(start, minutes) + '-' + self.format_time(end, minutes)
+                      for start, end in zip(minutes, ends)]
+        if len(labels) != len(minutes):
+            raise ValueError("one label for each slot is needed")
+        
+        self.step = step
+        self.labels = list(labels)
+        
+        # table[k] = slot of the time k * step minutes (slot -1 is the last one, wrapping the midnight)
+        table = np.searchsorted(minutes, np.arange(0, 1440, step), side='right') - 1
+        self.table = np.where(table < 0, len(minutes) - 1, table).astype('int16')
+
+    @staticmethod
+    def format_time(minute, minutes):
+        """
+        format a time as 'HH', or 'HH:MM' if some start time is not at o'clock
+        """
+        if all(m % 60 == 0 for m in minutes):
+            return '%02d' % (minute // 60)
+        return '%02d:%02d' % divmod(minute, 60)
+
+    @classmethod
+    def every(cls, minutes):
+        """
+        Return slots of the same length (e.g. every(15) gives the 96 quarters of hour)
+        """
+        starts = [m / 60 for m in range(0, 1440, minutes)]
+        labels = ['%02d:%02d' % divmod(m, 60) for m in range(0, 1440, minutes)]
+        return cls(starts, labels, step=minutes)
+
+    def categorical(self, codes):
+        """
+        Return the slots' codes as an (ordered by time) categorical
+        """
+        return pd.Categorical.from_codes(codes, dtype=pd.CategoricalDtype(self.labels, ordered=True))
+
+    def of_hours(self, hours):
+        """
+        Return the slot of each hour (0-23) as a categorical
+        """
+        return self.categorical(self.table.take(np.asarray(hours, dtype='int64') * 60 // self.step))
+
+    def bucket(self, datetimes):
+        """
+        Return the slot of each datetime of a column as a categorical,
+        in one vectorized pass
+        """
+        minute_of_day = np.asarray(datetimes, dtype='datetime64[m]').astype('int64') % 1440
+        return self.categorical(self.table.take(minute_of_day // self.step))
+
+
+# the time slots used in the analysis
+DEFAULT_TIME_SLOTS = TimeSlots([1, 6, 12, 17, 20])
+
+
+@instrumented('plot')
+def time_slots_and_plot (df, color, slots = None):
     """
-    Groups the dataframe by the index hour,
-    then with apply group it for time slots
+    Groups the passengers of the dataframe by time slots
     input:
     - df and the color of the instogram
+    - slots: a TimeSlots (DEFAULT: DEFAULT_TIME_SLOTS)
     output:
     - plot of the passengers for every hours per whole NYC
     """
-    # temporary df copied by the original df (without column 'PULocationID')
-    temp = df.drop('PULocationID',axis=1)
+    if slots is None:
+        slots = DEFAULT_TIME_SLOTS
     
-    # setting as index datetime
-    temp.set_index("tpep_pickup_datetime",inplace=True)
-    # grouping by hours (0-23)
-    temp=temp.groupby(temp.index.hour).sum()
-    # restoring the column 'tpep_pickup_datetime'
-    temp.reset_index(inplace=True)
-    # changig every hour in 'tpep_pickuptime' in the corresponding slot_time (Using time_slots)
-    temp['tpep_pickup_datetime'] = temp.tpep_pickup_datetime.apply(time_slots)
-    # groupying by time slots
-    temp = temp.groupby(temp.tpep_pickup_datetime).sum()
+    # time slot of every trip, then groupying by time slots
+    temp = df.groupby(slots.bucket(df['tpep_pickup_datetime']), observed=False)[['passenger_count']].sum()
     
     # plotting the result
     ax = temp.plot(figsize=(12,6), kind='bar',color=color, zorder=3)
@@ -335,25 +2874,33 @@ def time_slots_and_plot (df, color):
     return
 
 
-def passengers_for_each_borough (df, borough_lst, taxi_zone_lookup):
+@instrumented('plot')
+def passengers_for_each_borough (df, borough_lst, taxi_zone_lookup, slots = None):
     """
     Same function of time_slot_and_plot, but it considers borough
     input:
-    - df
+    - df (or a PartitionedFrame)
     - borough list containing the borough
-    - taxi_zone_lookup to merge with df to match taxi trips and boroughs
+    - taxi_zone_lookup to match taxi trips and boroughs
+    - slots: a TimeSlots (DEFAULT: DEFAULT_TIME_SLOTS)
     output:
     - borough plot for each borough
     """
     # plots colors
     plots_colors = ['royalblue', 'orange', 'violet', 'crimson', 'darkcyan', 'coral', 'mediumseagreen']
     
-    # merge df with taxi_zone_lookup
-    df = pd.merge(df,taxi_zone_lookup, how = "left", left_on="PULocationID", right_on= "LocationID")
-    df.drop(['PULocationID','LocationID'],axis=1,inplace=True)
+    if slots is None:
+        slots = DEFAULT_TIME_SLOTS
+    
+    if isinstance(df, PartitionedFrame):
+        df = df.frame
+    
+    # boroughs of PULocationID from taxi_zone_lookup and time slots of tpep_pickup_datetime
+    boroughs = zone_index(taxi_zone_lookup).lookup(df['PULocationID'])
+    time_slot = slots.bucket(df['tpep_pickup_datetime'])
 
-    # groupby Borough and datetime
-    df = df.groupby(["Borough","tpep_pickup_datetime"]).sum()
+    # groupby Borough and time slot
+    df = df.groupby([boroughs, time_slot], observed=False)[['passenger_count']].sum()
     
     # Now we have a dataframe grouped by boroughs
     
@@ -362,14 +2909,6 @@ def passengers_for_each_borough (df, borough_lst, taxi_zone_lookup):
         
         # temp is our new sub dataframe, referred to the i borough in borough list
         temp = df.loc[borough_lst[i]]
-        # group them by hours
-        temp = temp.groupby(temp.index.hour).sum()
-        # restore tpep_pickup_datetime (contains the average for every hour)
-        temp.reset_index(inplace=True)
-        # make time slots
-        temp['tpep_pickup_datetime'] = temp.tpep_pickup_datetime.apply(time_slots)
-        # groupby time_slots
-        temp = temp.groupby('tpep_pickup_datetime').sum()
         
         # make plot
         f = plt.figure()
@@ -384,53 +2923,92 @@ def passengers_for_each_borough (df, borough_lst, taxi_zone_lookup):
     return
 ###RQ3
 
-def make_duration_df (df_names, taxi_zone_lookup):
+def duration_month (df_name, zones, chunksize = None):
     """
-    Make the dataframe with colums 'durations' and 'Borough'
+    Make the dataframe of a month with colums 'durations' (int32 seconds) and 'Borough' (categorical),
+    keeping only durations in range (2 min, 1h:30m)
     input:
-    - df name's list
-    - taxi_zone_lookup
+    - df name
+    - ZoneIndex of taxi_zone_lookup
+    - chunksize: if given, the file is read and filtered chunksize rows at a time (DEFAULT: None)
     output:
     - a new dataframe
     """
-    # creating a new empty df
-    trip_duration = pd.DataFrame()
+    # filtered chunks of the month
+    parts = []
     
-    # appending rows to trip_duration df
-    for i, df_name in enumerate(df_names):
+    for chunk in iter_trips(df_name, ['tpep_pickup_datetime','tpep_dropoff_datetime', 'PULocationID'], chunksize):
         
-        # load csv file
-        df = pd.read_csv(df_name,usecols=['tpep_pickup_datetime','tpep_dropoff_datetime', 'PULocationID'],
-                         parse_dates=["tpep_pickup_datetime",'tpep_dropoff_datetime'])
-            
-        # merge with lookup_table to get boroughs
-        df = pd.merge(df,taxi_zone_lookup, how="left", left_on="PULocationID", right_on="LocationID")
-
-        #drop out unused columns
-        df.drop(['PULocationID', 'LocationID', 'Zone', 'service_zone'], axis=1, inplace=True)
-
-        # make the column durations and put it into tpep_dropoff_datetime
-        df['tpep_dropoff_datetime'] = ((df['tpep_dropoff_datetime']-df['tpep_pickup_datetime'])/np.timedelta64(1, 's')).astype(int)
+        durations = trip_durations(chunk['tpep_pickup_datetime'], chunk['tpep_dropoff_datetime'])
+        
+        # filtering before keeping the chunk: durations in range (2 min, 1h:30m)
+        keep = (durations > 120) & (durations < 5400)
+        
+        parts.append(pd.DataFrame({'durations': durations[keep].astype('int32'),
+                                   'Borough': zones.lookup(chunk['PULocationID'].values[keep])},
+                                  index=chunk.index[keep]))
+    
+    return concat_months(parts)
 
-        # drop out the other column tpep_pickup_datetime
-        df.drop('tpep_pickup_datetime',axis=1,inplace=True)
 
-        # append the duration at the new df
-        trip_duration = trip_duration.append(df)
-    
-    
-    # change the name 'tpep_dropoff_datetime' in 'durations'
-    trip_duration.rename(columns={"tpep_dropoff_datetime":"durations"}, inplace=True)
+def duration_histogram_month (df_name, zones, bins, chunksize = None):
+    """
+    Count the trips' durations of a month in bins, for each borough
+    input:
+    - df name
+    - ZoneIndex of taxi_zone_lookup
+    - bins: sorted edges of the bins in seconds (each bin includes its left edge)
+    - chunksize: if given, the file is read chunksize rows at a time (DEFAULT: None)
+    output:
+    - dataframe of counts: one row for each bin, one column for each borough
+    """
+    bins = np.asarray(bins)
+    boroughs = zones.categories['Borough']
+    n_bins = len(bins) - 1
     
+    counts = np.zeros(len(boroughs) * n_bins, dtype='int64')
     
-    # filtering df values:
-    # keep durations in range (2 min, 1h:30m)
-    trip_duration = trip_duration[ (trip_duration['durations']>120) & (trip_duration['durations']<5400)]
+    for chunk in iter_trips(df_name, ['tpep_pickup_datetime','tpep_dropoff_datetime', 'PULocationID'], chunksize):
+        
+        durations = trip_durations(chunk['tpep_pickup_datetime'], chunk['tpep_dropoff_datetime'])
+        codes = zones.codes_of(chunk['PULocationID']).astype('int64')
+        bin_of = np.searchsorted(bins, durations, side='right') - 1
+        
+        # trips with a known borough and inside the bins
+        keep = (codes >= 0) & (bin_of >= 0) & (bin_of < n_bins)
+        counts += np.bincount(codes[keep] * n_bins + bin_of[keep], minlength=len(counts))
     
+    return pd.DataFrame(counts.reshape(len(boroughs), n_bins).T, columns=boroughs,
+                        index=pd.IntervalIndex.from_breaks(bins, closed='left'))
 
-    #return the new data_frame
+
+@instrumented('analysis')
+@disk_memoize()
+def make_duration_df (df_names, taxi_zone_lookup, lazy = False, processes = 1, chunksize = None, bins = None,
+                      aggregates = None, partition = False):
+    """
+    Make the dataframe with colums 'durations' and 'Borough'
+    input:
+    - df name's list
+    - taxi_zone_lookup
+    - lazy: if True return a generator of the months' dataframes (DEFAULT: False)
+    - processes: number of worker processes loading the months (DEFAULT: 1)
+    - chunksize: if given, the files are read and filtered chunksize rows at a time (DEFAULT: None)
+    - bins: if given (edges in seconds), return the histogram of the durations
+      for each borough instead of the trips (see duration_histogram_month)
+    - aggregates: AggregateStore (or directory) with the histograms of the months already counted
+    - partition: if True, return a PartitionedFrame (the trips sorted by borough, DEFAULT: False)
+    output:
+    - a new dataframe
+    """
+    zones = zone_index(taxi_zone_lookup)
+    
+    if bins is not None:
+        return reduce_months(duration_histogram_month, df_names, zones, np.asarray(bins), chunksize,
+                             processes=processes, aggregates=aggregates)
     
-    return trip_duration
+    res = load_months(duration_month, df_names, zones, chunksize, lazy=lazy, processes=processes)
+    return partition_months(res, lazy, partition)
 
 
 # old function, not used now
@@ -454,16 +3032,17 @@ def plot_durations(df,zone_name, bins = 3600):
     return
 
 # old function, not used now
+@instrumented('plot')
 def plot_Boroughs_durations (df, borough_lst):
     """
     plot durations' density for each borow
     input:
-    - df
+    - df (or PartitionedFrame)
     - borough list
     """
     for i in range(len(borough_lst)):
         
-        temp = df[df['Borough'] == borough_lst[i]]
+        temp = group_rows(df, borough_lst[i])
         
         # using the function plot durations:
         # due EWR and Staten Island have less trips, we use 100 bins instead
@@ -476,27 +3055,34 @@ def plot_Boroughs_durations (df, borough_lst):
     return
 
 
+@instrumented('plot')
 def plot_frequencies (column, zone_name, bins = 30, xlim = 28, color = 'darkcyan' ):
     """
     Plot duration frequencies
     input:
-    - df single attribute
+    - df single attribute, or a Histogram of it (its bins are merged to have about `bins` bins)
     - zone_name (string)
     - bins (def 30) xlim (def 29) color (def 'darkcyan')
     """
     
-    temp = pd.DataFrame()
-    temp['values'] = column
-    
-    temp['new_col'] = pd.cut(temp['values'], bins=bins,precision=0)
-    temp = temp.groupby('new_col').count()
-    
-    x = [str(i) for i in temp.index]
+    if isinstance(column, Histogram):
+        hist = column.rebin(max(1, len(column.counts) // bins))
+        x = hist.labels()
+        heights = hist.counts
+    else:
+        temp = pd.DataFrame()
+        temp['values'] = column
+        
+        temp['new_col'] = pd.cut(temp['values'], bins=bins,precision=0)
+        temp = temp.groupby('new_col', observed=False).count()
+        
+        x = [str(i) for i in temp.index]
+        heights = temp['values']
     
     f = plt.figure()
-    ax = plt.bar(x = x, height=temp['values'], color = color)
+    ax = plt.bar(x = x, height=heights, color = color)
     plt.title('trips duration\'s frequency in %s' %zone_name)
-    plt.xticks (list(range(xlim-1)), x , rotation=90)
+    plt.xticks (list(range(xlim-1)), x[:xlim-1] , rotation=90)
     plt.xlim(-1,xlim)
     plt.xlabel('trips_duration in seconds')
     plt.ylabel('frequency')
@@ -507,12 +3093,13 @@ def plot_frequencies (column, zone_name, bins = 30, xlim = 28, color = 'darkcyan
     plt.show()
     return
 
+@instrumented('plot')
 def Boroughs_durations_freq (df, borough_lst):
     """
     for each borough plot the durations frequencies
     using the func plot_frequencies()
     input:
-    - df
+    - df (or PartitionedFrame), or the histograms' table of make_duration_df(..., bins=...)
     - borough_lst
     """
     plots_colors = ['royalblue', 'orange', 'mediumseagreen', 'crimson',
@@ -520,51 +3107,60 @@ def Boroughs_durations_freq (df, borough_lst):
         
     for i in range(len(borough_lst)):
     
-        temp = df[df['Borough'] == borough_lst[i]]
+        if isinstance(df, pd.DataFrame) and isinstance(df.index, pd.IntervalIndex):
+            durations = Histogram(np.append(df.index.left, df.index.right[-1]), df[borough_lst[i]])
+        else:
+            durations = group_rows(df, borough_lst[i])['durations']
         
         if (borough_lst[i] == 'EWR') or (borough_lst[i] == 'Staten Island'):
-            plot_frequencies(temp['durations'], borough_lst[i],color=plots_colors[i], bins=20, xlim=21)
+            plot_frequencies(durations, borough_lst[i],color=plots_colors[i], bins=20, xlim=21)
         elif borough_lst[i] == 'Manhattan':
-            plot_frequencies(temp['durations'],borough_lst[i],color=plots_colors[i], bins=45, xlim=36)
+            plot_frequencies(durations,borough_lst[i],color=plots_colors[i], bins=45, xlim=36)
         elif (borough_lst[i] == 'Bronx') or (borough_lst[i] == 'Queens'):
-            plot_frequencies(temp['durations'],borough_lst[i],color=plots_colors[i], bins=25, xlim=26 )
+            plot_frequencies(durations,borough_lst[i],color=plots_colors[i], bins=25, xlim=26 )
 
     return
 
 ####RQ4
 
-def payments_per_borough(df_names,taxi_zone_lookup,borough_lst):
+def payments_month(df_name, zones, chunksize = None):
+    """
+    return the ContingencyTable of the trips of a month for every (Borough, payment_type)
+    """
+    return contingency_month(df_name, 'Borough', 'payment_type', zones, chunksize)
+
+
+@instrumented('analysis')
+def payments_per_borough(df_names,taxi_zone_lookup,borough_lst, processes = 1, aggregates = None, chunksize = None):
     """
     compute the contingency table for every payment type for each borough
     input:
     - list of names of csv file to open
     - borough_lst 
+    - processes: number of worker processes counting the months (DEFAULT: 1)
+    - aggregates: AggregateStore (or directory) with the tables of the months already counted
+    - chunksize: if given, the files are read chunksize rows at a time (DEFAULT: None)
     output:
     - data frame of frequencies of each payment for every borough and the list of all possible payment types
     """
     payment_type=['Credit card','Cash','No charge','Dispute','Unknown','Voided trip']
+    zones = zone_index(taxi_zone_lookup)
 
-    res=[] #list to store parts of dataframe grouped by Borough and payment_type
-
-    for i,df_name in enumerate(df_names): #repeating it for every fail(aka month)
-            # load the ith dataframe, taking only 2 columns
-            df = pd.read_csv(df_name,usecols= ['payment_type','PULocationID'])
-            
-            # merging it with taxi_zone_lookup file(left-join) 
-            df=pd.merge(df,taxi_zone_lookup,how='left',left_on='PULocationID',right_on='LocationID')
-
-            res.append(df.groupby(['payment_type','Borough']).count().iloc[:,0]) 
+    # counting every month (aka file) and summing the values for each payment type and borough
+    res = reduce_months(payments_month, df_names, zones, chunksize, processes=processes,
+                        aggregates=aggregates)
     
-    #concatenating the results for all months and summing the values for each payment type
-    res=pd.DataFrame(pd.concat(res,axis=1).sum(axis=1))
-    res.reset_index(inplace=True)
-    contingency_table=res.pivot(index='Borough', columns='payment_type', values=0).fillna(0)
+    # only the boroughs and payment types with some trips
+    contingency_table = res.frame(drop_empty=True)
+    contingency_table.index = pd.CategoricalIndex(contingency_table.index, categories=zones.categories['Borough'],
+                                                  name='Borough')
     #change name of columns (instead of numbers(1,...,6) names of payment types)
     contingency_table.columns = [payment_type[i-1] for i in contingency_table.columns] 
     
     return contingency_table,payment_type
         
         
+@instrumented('plot')
 def payment_type_per_borough_plot(contingency_table,payment_type_lst):
     """
     plots the payment types for each borough
@@ -582,6 +3178,7 @@ def payment_type_per_borough_plot(contingency_table,payment_type_lst):
         ax=sns.pointplot(x=contingency_table.columns, y=row, markersize=13,color=colors[ind])
         plt.show()
 
+@instrumented('plot')
 def payment_types_NYC_plot(payment_type_all,payment_type_lst):
     """
     plots the payment types for all NYC
@@ -600,53 +3197,89 @@ def payment_types_NYC_plot(payment_type_all,payment_type_lst):
 
 #####RQ5
 
-def duration_distance_df (df_names):
+def duration_distance_month (df_name, chunksize = None):
+    """
+        return the dataframe of a month with trip duration (int32 seconds) and distances
+        """
+    # filtered chunks of the month
+    parts = []
+    
+    # load the dataframe, taking only the datetimes and trip_distance columns
+    for chunk in iter_trips(df_name, ['tpep_pickup_datetime','tpep_dropoff_datetime','trip_distance'], chunksize):
+        
+        durations = trip_durations(chunk['tpep_pickup_datetime'], chunk['tpep_dropoff_datetime'])
+        distances = chunk['trip_distance'].values
+        
+        # filtering duration and distance
+        keep = (durations > 120) & (durations < 3600*2) & (distances > 1.2) & (distances < 50)
+        
+        parts.append(pd.DataFrame({'trip_duration': durations[keep].astype('int32'),
+                                   'trip_distance': distances[keep]}, index=chunk.index[keep]))
+    
+    return concat_months(parts)
+
+
+@instrumented('analysis')
+@disk_memoize()
+def duration_distance_df (df_names, lazy = False, processes = 1, chunksize = None):
     """
         return a dataframe with trip duration and distances
         input:
         - df_names list
+        - lazy: if True return a generator of the months' dataframes (DEFAULT: False)
+        - processes: number of worker processes loading the months (DEFAULT: 1)
+        - chunksize: if given, the files are read and filtered chunksize rows at a time (DEFAULT: None)
         output
         - new dataframe
         """
-    
-    res_df=pd.DataFrame()
-    
-    for i,df_name in enumerate (df_names):
-        # load the ith dataframe, taking only the t_pickup_datetime column
-        df = pd.read_csv(df_name,usecols= ['tpep_pickup_datetime','tpep_dropoff_datetime','trip_distance'],
-                         parse_dates= ["tpep_pickup_datetime",'tpep_dropoff_datetime'])
-
-        df['trip_duration']= ((df['tpep_dropoff_datetime']-df['tpep_pickup_datetime'])/ np.timedelta64(1, 's')).astype(int)
+    return load_months(duration_distance_month, df_names, chunksize, lazy=lazy, processes=processes)
 
+def duration_distance_histograms (df):
+    """
+    Return the histograms of trip_duration (5 seconds bins) and trip_distance (1/24 mile bins)
+    of a dataframe, in the ranges kept by duration_distance_df
+    """
+    return {'trip_duration': Histogram.linear(0, 3600*2, 1440).update(df['trip_duration']),
+            'trip_distance': Histogram.linear(0, 50, 1200).update(df['trip_distance'])}
 
-        res_df=res_df.append(df.loc[:,['trip_duration','trip_distance']])
 
-    # filtering duration
-    res_df = res_df[(res_df['trip_duration'] > 120) & (res_df['trip_duration'] < 3600*2)]
-    # filtering distance
-    res_df= res_df[(res_df['trip_distance'] > 1.2 )&(res_df['trip_distance'] < 50)]
+def plot_hist_and_kde (hist, ax, bars, color, kde_color):
+    """
+    plot the density of a Histogram with about `bars` bars and its binned KDE on ax
+    """
+    coarse = hist.rebin(max(1, len(hist.counts) // bars))
+    ax.bar(coarse.edges[:-1], coarse.density(), width=coarse.widths(), align='edge',
+           edgecolor="black", color=color)
     
-    return res_df
+    centers, density = hist.kde()
+    ax.plot(centers, density, color=kde_color)
+    return
 
+
+@instrumented('plot')
 def plot_duration_distance_freq (df):
     """
     plot duration and distance frequencies
     input:
-    - df with trip_distance and trip_duration
+    - df with trip_distance and trip_duration, or a dictionary with a Histogram
+      for 'trip_duration' and 'trip_distance' (see duration_distance_histograms)
     """
     
+    if isinstance(df, pd.DataFrame):
+        df = duration_distance_histograms(df)
+    
     f = plt.figure()
     ax1 = f.add_subplot(221)
     ax2 = f.add_subplot(222)
     
-    df['trip_duration'].plot(kind = 'kde',color='darkgreen',ax=ax1, xlim=(0,4000))
-    df['trip_duration'].plot(kind='hist',edgecolor="black", density=True, color='honeydew',bins=40,ax=ax1)
+    plot_hist_and_kde(df['trip_duration'], ax1, 40, 'honeydew', 'darkgreen')
+    ax1.set_xlim(0,4000)
     ax1.set_xlabel('time [s]')
     ax1.title.set_text('trip duration frequency')
     
     
-    df['trip_distance'].plot(kind = 'kde',color='darkblue',ax=ax2, xlim = (0,30))
-    df['trip_distance'].plot(kind='hist',edgecolor="black", density=True, color='lavender',bins=30,ax=ax2)
+    plot_hist_and_kde(df['trip_distance'], ax2, 30, 'lavender', 'darkblue')
+    ax2.set_xlim(0,30)
     
     ax2.title.set_text('trip distance frequency')
     ax2.set_xlabel('miles')
@@ -656,75 +3289,145 @@ def plot_duration_distance_freq (df):
     
     return
 
-# CQ1
+# CQ1
+
+PRICE_PER_MILE_COLUMNS = ['tpep_pickup_datetime','tpep_dropoff_datetime','trip_distance','PULocationID','fare_amount']
+
+
+def price_per_mile_month(df_name, zones):
+    """
+    return the dataframe of a month with following attributes:
+    'trip_duration', 'price per mile', 'Borough'
+    """
+    # load the dataframe
+    return price_per_mile_trips(load_trips(df_name, PRICE_PER_MILE_COLUMNS), zones)
+
+
+def price_per_mile_trips(df, zones):
+    """
+    same of price_per_mile_month, for a dataframe (or chunk) with the PRICE_PER_MILE_COLUMNS
+    """
+    # making column trip duration
+    df['trip_duration']= ((df['tpep_dropoff_datetime']-df['tpep_pickup_datetime'])/ np.timedelta64(1, 's')).astype(int)
+
+    df['price_per_mile']=round(df['fare_amount']/df.trip_distance, 2)
+
+    # dropping out some col
+    df.drop(columns=['tpep_dropoff_datetime','tpep_pickup_datetime'], inplace=True)
+
+    df.drop(columns=['trip_distance','fare_amount'], inplace=True)
+
+    # boroughs from taxi_zone_lookup
+    df['Borough'] = zones.lookup(df['PULocationID'])
+
+    df.drop(columns=['PULocationID'], inplace=True)
 
-def make_df_price_per_mile(df_names,taxi_zone_lookup):
+    # filtering trip_duration values
+    df = df[(df['trip_duration'] > 120) & (df['trip_duration']<5400)]
+    # filtering price_per_mile
+    return df[(df['price_per_mile'] > 1.5) & (df['price_per_mile'] < 30 )]
+
+
+@instrumented('analysis')
+@disk_memoize()
+def make_df_price_per_mile(df_names,taxi_zone_lookup, lazy = False, processes = 1, partition = False):
     """
     filter csv files, return a dataframe:
     input:
     df_names, table_taxi
+    lazy: if True return a generator of the months' dataframes (DEFAULT: False)
+    processes: number of worker processes loading the months (DEFAULT: 1)
+    partition: if True, return a PartitionedFrame (the trips sorted by borough, DEFAULT: False)
     -output: following attributes:
     'price per mile', 'trip_distance', 'borough'
     
     """
+    res = load_months(price_per_mile_month, df_names, zone_index(taxi_zone_lookup), lazy=lazy, processes=processes)
+    return partition_months(res, lazy, partition)
 
-    temp=pd.DataFrame() #list to store parts of dataframe grouped by Borough and payment_type
 
-    for i,df_name in enumerate(df_names): #repeating it for every fail(aka month)
-        # load the ith dataframe
-        df = pd.read_csv(df_name,usecols= ['tpep_pickup_datetime','tpep_dropoff_datetime','trip_distance','PULocationID','fare_amount'],
-                         parse_dates= ["tpep_pickup_datetime",'tpep_dropoff_datetime'])
-            
-        # making column trip duration
-        df['trip_duration']= ((df['tpep_dropoff_datetime']-df['tpep_pickup_datetime'])/ np.timedelta64(1, 's')).astype(int)
-
-        df['price_per_mile']=round(df['fare_amount']/df.trip_distance, 2)
-
-        # dropping out some col
-        df.drop(columns=['tpep_dropoff_datetime','tpep_pickup_datetime'], inplace=True)
+def price_per_mile_stats_month(df_name, zones, chunksize = None):
+    """
+    Return the GroupedStats of 'price_per_mile', 'trip_duration' and 'p1' (price_per_mile / trip_duration)
+    of the trips of a month for each borough (groups: zones.categories['Borough'])
+    """
+    res = GroupedStats(zones.categories['Borough'], PRICE_PER_MILE_ATTRIBUTES)
+    
+    for chunk in iter_trips(df_name, PRICE_PER_MILE_COLUMNS, chunksize):
+        trips = price_per_mile_trips(chunk, zones)
+        trips['p1'] = trips['price_per_mile'] / trips['trip_duration']
+        res.update(trips['Borough'].cat.codes, trips)
+    return res
 
-        df.drop(columns=['trip_distance','fare_amount'], inplace=True)
 
-        # merging it with taxi_zone_lookup file(left-join)
-        df=pd.merge(df,taxi_zone_lookup,how='left',left_on='PULocationID',right_on='LocationID')
+# attributes of the GroupedStats of price_per_mile_stats_month
+PRICE_PER_MILE_ATTRIBUTES = ['price_per_mile', 'trip_duration', 'p1']
 
-        df.drop(columns=['PULocationID','LocationID','Zone','service_zone'], inplace=True)
-            
-        temp = temp.append(df)
 
-    # filtering trip_duration values
-    temp = temp[(temp['trip_duration'] > 120) & (temp['trip_duration']<5400)]
-    # filtering price_per_mile
-    temp = temp[(temp['price_per_mile'] > 1.5) & (temp['price_per_mile'] < 30 )]
-    return temp
+@instrumented('analysis')
+def make_price_per_mile_stats(df_names, taxi_zone_lookup, processes = 1, chunksize = None, aggregates = None):
+    """
+    Return the GroupedStats of 'price_per_mile', 'trip_duration' and 'p1' for each borough
+    of all the months, without keeping the trips in memory (tables with mean_std_table and p_value_table)
+    input:
+    - df_names
+    - taxi_zone_lookup
+    - processes: number of worker processes (DEFAULT: 1)
+    - chunksize: if given, the files are read chunksize rows at a time (DEFAULT: None)
+    - aggregates: AggregateStore (or directory) with the stats of the months already computed
+    """
+    return reduce_months(price_per_mile_stats_month, df_names, zone_index(taxi_zone_lookup), chunksize,
+                         processes=processes, aggregates=aggregates)
 
 
 def make_boro_dict (df, borough_lst):
     """
     return a dictionary with a dataframe for each borough
+    (slices without copies if df is a PartitionedFrame, see make_df_price_per_mile)
     output: df_dict with following attributes:
     'price per mile', 'trip_distance', 'borough'
     """
     boro_dict = {}
 
     for i in range (len(borough_lst)):
-        boro_dict[i] = df[df['Borough'] == borough_lst[i]]
+        boro_dict[i] = group_rows(df, borough_lst[i])
 
     return boro_dict
 
 
+def grouped_stats (boro_dict, borough_lst, attribute):
+    """
+    Return the GroupedStats of attribute for each borough of borough_lst
+    input:
+    - a GroupedStats (returned as it is), the dataframe with the 'Borough' column,
+      or boro_dict (see make_boro_dict)
+    """
+    if isinstance(boro_dict, GroupedStats):
+        return boro_dict
+    if isinstance(boro_dict, pd.DataFrame):
+        return GroupedStats.from_frame(boro_dict, [attribute], groups=borough_lst)
+    
+    res = GroupedStats(borough_lst, [attribute])
+    for i in range(len(borough_lst)):
+        res.update(np.full(len(boro_dict[i]), i), boro_dict[i])
+    return res
+
+
 def mean_std_table (boro_dict,borough_lst, attribute):
     """
     make a table with means and std for each borough
+    input:
+    - boro_dict (see make_boro_dict), the dataframe with the 'Borough' column,
+      or the GroupedStats of make_price_per_mile_stats
+    - borough_lst
+    - attribute
     """
-    mean_std_table = pd.DataFrame(columns= ['Borough', 'Mean', 'Std'])
+    table = grouped_stats(boro_dict, borough_lst, attribute).table(attribute).reindex(borough_lst)
 
-    for i, boro in enumerate(boro_dict.values()):
-        mean_std_table.loc[i] = [borough_lst[i], round(boro[attribute].mean(),3),
-                                 round(boro[attribute].std(),3)]
-
-    return mean_std_table
+    return pd.DataFrame({'Borough': borough_lst, 'Mean': table['mean'].round(3).values,
+                         'Std': table['std'].round(3).values})
 
+@instrumented('plot')
 def plot_price_per_mile (boro_dict, borough_lst):
     
     fig, axes = plt.subplots (nrows=3, ncols=2)
@@ -777,17 +3480,92 @@ def color_negative_red (value):
     return ('color: %s' %color)
 
 
-def p_value_table (boro_dict, borough_lst, attribute):
+def adjust_p_values (p_values, correction):
+    """
+    Correct p values for multiple comparisons
+    input:
+    - 1-D array of p values
+    - correction: 'bonferroni', 'holm' or 'fdr_bh' (Benjamini-Hochberg)
+    """
+    p_values = np.asarray(p_values, dtype='float64')
+    m = len(p_values)
+    
+    if correction == 'bonferroni':
+        return np.minimum(p_values * m, 1)
+    
+    order = np.argsort(p_values)
+    sorted_p = p_values[order]
+    
+    if correction == 'holm':
+        adjusted = np.maximum.accumulate(sorted_p * (m - np.arange(m)))
+    elif correction == 'fdr_bh':
+        adjusted = np.minimum.accumulate((sorted_p * m / np.arange(1, m + 1))[::-1])[::-1]
+    else:
+        raise ValueError("unknown correction %s" %correction)
+    
+    res = np.empty(m)
+    res[order] = np.minimum(adjusted, 1)
+    return res
+
+
+def welch_p_values (n, mean, var, correction = None):
+    """
+    Return the matrix of the p values of Welch's t test for every pair of groups,
+    from the sufficient statistics of the groups (1 on the diagonal)
+    input:
+    - n, mean, var: arrays with count, mean and sample variance of each group
+    - correction: None (DEFAULT), or 'bonferroni', 'holm', 'fdr_bh' applied to the k(k-1)/2 pairs
+    """
+    n = np.asarray(n, dtype='float64')
+    mean = np.asarray(mean, dtype='float64')
+    var = np.asarray(var, dtype='float64')
+    
+    # squared standard errors of the means
+    se2 = var / n
+    se2_sum = se2[:, None] + se2[None, :]
     
-    p_value_table = pd.DataFrame(columns= borough_lst)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (mean[:, None] - mean[None, :]) / np.sqrt(se2_sum)
+        # Welch-Satterthwaite degrees of freedom
+        dof = se2_sum ** 2 / (se2[:, None] ** 2 / (n[:, None] - 1) + se2[None, :] ** 2 / (n[None, :] - 1))
+        p = 2 * stdtr(dof, -np.abs(t))
+    
+    if correction is not None:
+        upper = np.triu_indices(len(n), k=1)
+        tested = ~np.isnan(p[upper])
+        corrected = p[upper]
+        corrected[tested] = adjust_p_values(corrected[tested], correction)
+        p[upper] = corrected
+        p.T[upper] = corrected
+    
+    np.fill_diagonal(p, 1)
+    return p
 
-    for i, bor in enumerate(boro_dict):
-        p_value_row_i = [round(ttest_ind(boro_dict[i][attribute], boro_dict[j][attribute])[1],3) for j in range(0,6)]
-        p_value_table.loc[borough_lst[i]] = p_value_row_i
 
-    return p_value_table.style.applymap(color_negative_red, subset= borough_lst)
+def p_value_table (boro_dict, borough_lst, attribute, correction = None):
+    """
+    Table of the p values of Welch's t test of attribute between every pair of boroughs
+    input:
+    - boro_dict (see make_boro_dict), the dataframe with the 'Borough' column, the GroupedStats
+      of make_price_per_mile_stats, or a table with 'n', 'mean', 'var' for each borough
+    - borough_lst
+    - attribute
+    - correction: multiple comparisons correction, None (DEFAULT), 'bonferroni', 'holm' or 'fdr_bh'
+    output:
+    - styled dataframe (p values <= 0.05 in green)
+    """
+    if isinstance(boro_dict, pd.DataFrame) and {'n', 'mean', 'var'} <= set(boro_dict.columns):
+        table = boro_dict.reindex(borough_lst)
+    else:
+        table = grouped_stats(boro_dict, borough_lst, attribute).table(attribute).reindex(borough_lst)
+    
+    p = welch_p_values(table['n'], table['mean'], table['var'], correction)
+    p_value_table = pd.DataFrame(p, index=borough_lst, columns=borough_lst).round(3)
+
+    return p_value_table.style.map(color_negative_red, subset= borough_lst)
 
 
+@instrumented('plot')
 def plot_p1 (boro_dict, borough_lst):
     
     fig, axes = plt.subplots (nrows=3, ncols=2)
@@ -828,59 +3606,457 @@ def plot_p1 (boro_dict, borough_lst):
 
 # CQ2
 
-def take_pickup_and_dropoff_zones(df_names, taxi_zone_lookup):
+def pickup_and_dropoff_zones_month(df_name, zones):
+    """
+        return the dataframe of a month with the zones of taxi_zone_lookup for PULocationID
+    """
+    # load the dataframe, taking only 2 columns
+    df = load_trips(df_name, ['PULocationID', 'DOLocationID'])
+    
+    # columns of taxi_zone_lookup for PULocationID (LocationID is missing for unknown ids)
+    df['LocationID'] = df['PULocationID'].where(zones.contains(df['PULocationID']))
+    for col in ZONE_COLUMNS:
+        df[col] = zones.lookup(df['PULocationID'], col)
+
+    return df
+
+
+@instrumented('analysis')
+@disk_memoize()
+def take_pickup_and_dropoff_zones(df_names, taxi_zone_lookup, lazy = False, processes = 1):
     """
-        return the dataframe merged with taxi_zone_lookup
+        return the dataframe with the zones of taxi_zone_lookup for PULocationID
         input:
         - df_names (list of csv files)
         - taxi_zone_lookup (path of taxi_zone_lookup)
+        - lazy: if True return a generator of the months' dataframes (DEFAULT: False)
+        - processes: number of worker processes loading the months (DEFAULT: 1)
         output:
         - a dataframe
     """
-    
-    # dataframe to be load
-    res=pd.DataFrame()
-    
-    for i,df_name in enumerate(df_names): #repeating it for every fail(aka month)
-        # load the ith dataframe, taking only 2 columns
-        df = pd.read_csv(df_name,usecols= ['PULocationID', 'DOLocationID'])
-        
-        # merging it with taxi_zone_lookup file(left-join)
-        
-        df=pd.merge(df,taxi_zone_lookup,how='left',left_on='PULocationID',right_on=['LocationID'])
-            
-        res=res.append(df)
+    return load_months(pickup_and_dropoff_zones_month, df_names, zone_index(taxi_zone_lookup),
+                       lazy=lazy, processes=processes)
+
 
-    return res
 
+def location_counts (location_ids, n_zones, weights = None):
+    """
+        counts the occurrences (or sums the weights) of each LocationID from 1 to n_zones
+        input:
+        - location_ids: array of LocationIDs, or an iterable of arrays (e.g. chunks)
+        - n_zones: number of zones (the highest LocationID)
+        - weights: values to sum for each trip (passengers, fare, distance...), with the same
+          shape of location_ids (DEFAULT: None, trips are counted)
+        output:
+        - numpy array with n_zones values, the ith value is for LocationID i+1
+    """
+    # a single array (also a nullable pandas array) is a single chunk
+    if isinstance(location_ids, (np.ndarray, pd.Series, pd.Index, pd.api.extensions.ExtensionArray)):
+        location_ids = [location_ids]
+        weights = None if weights is None else [weights]
+    
+    res = np.zeros(n_zones + 1, dtype='int64' if weights is None else 'float64')
+    
+    if weights is None:
+        weights = itertools.repeat(None)
+    
+    for ids, w in zip(location_ids, weights):
+        ids = int_codes(ids)
+        keep = (ids >= 0) & (ids <= n_zones)
+        if w is not None:
+            # missing weights (e.g. passenger_count) count as 0
+            if isinstance(w, (pd.Series, pd.Index, pd.api.extensions.ExtensionArray)):
+                w = w.to_numpy(dtype='float64', na_value=np.nan)
+            w = np.asarray(w, dtype='float64')[keep]
+            w = np.where(np.isnan(w), 0, w)
+        res += np.bincount(ids[keep], weights=w, minlength=n_zones + 1).astype(res.dtype)
+    
+    return res[1:]
 
 
-def Locations_counter (df, type_of_LocID):
+def Locations_counter (df, type_of_LocID, taxi_zone_lookup = None, weights = None):
     """
         it counts in df the occurrences of each LocID contained in'type_of_LocID' (df's parameter)
         and returns them as a list. It's used for columns 'PULocationID' and 'DOLocationID'
         input:
         - df
         - type_of_locID
+        - taxi_zone_lookup: if given, the number of zones is taken from it (DEFAULT: 265 zones)
+        - weights: column of df to sum instead of counting the trips (e.g. 'passenger_count')
         output:
-        - a list with 256 values (for each LocID)
+        - a list with a value for each LocID (265 values)
     """
     
-    #temp dataframe, it will take before the counters of PULocID and then DOLocID
-    occurrencies = pd.DataFrame()
+    n_zones = 265 if taxi_zone_lookup is None else zone_index(taxi_zone_lookup).size - 1
     
-    #groupying by locationID (PULocationID or DOLocationID)
-    occurrencies['LocID'] = df.groupby(type_of_LocID).count()['LocationID']
+    # only the trips with a LocationID of taxi_zone_lookup
+    known = df['LocationID'].notna().values
+    
+    counts = location_counts(df[type_of_LocID].values[known], n_zones,
+                             None if weights is None else df[weights].values[known])
+    return counts.tolist()
+
+
+# parsed (and compacted) geometries of the zones:
+# (absolute path, file signature, precision) -> geojson dictionary
+_geometry_cache = {}
+
+
+def compact_coordinates(coords, precision):
+    """
+        round the coordinates of a geojson geometry to `precision` decimals and
+        drop the points of the rings equal to the previous one after the rounding
+    """
+    # a single point
+    if len(coords) > 0 and isinstance(coords[0], (int, float)):
+        return [round(c, precision) for c in coords]
     
-    new_lst = []
+    # a ring (or a line): list of points
+    if len(coords) > 0 and len(coords[0]) > 0 and isinstance(coords[0][0], (int, float)):
+        points = np.round(np.asarray(coords, dtype='float64'), precision)
+        keep = np.r_[True, np.any(np.diff(points, axis=0) != 0, axis=1)]
+        # a ring needs at least 4 points
+        if keep.sum() >= 4:
+            points = points[keep]
+        return points.tolist()
     
-    for i in range (1,266):
-        if i in occurrencies.index:
-            new_lst.append(int(occurrencies.loc[i]))
-        else:
-            new_lst.append(0)
+    # polygons, multipolygons...
+    return [compact_coordinates(c, precision) for c in coords]
+
+
+def load_geometry(json_filename, precision = 5, properties = ('LocationID',)):
+    """
+        load the geojson of the zones once, keeping only some properties and
+        rounding the coordinates (5 decimals are about 1 meter),
+        the next calls with the same file return the same (cached) dictionary
+        input:
+        - json_filename
+        - precision: number of decimals of the coordinates (None to keep them all)
+        - properties: properties of the features to keep (None to keep them all)
+        output:
+        - geojson dictionary (shared by all the calls, it shouldn't be modified)
+    """
+    key = (os.path.abspath(json_filename), file_signature(json_filename), precision,
+           None if properties is None else tuple(properties))
+    
+    if key not in _geometry_cache:
+        with open(json_filename) as f:
+            json_data = json.load(f)
+        
+        for feature in json_data['features']:
+            if properties is not None:
+                feature['properties'] = {k: v for k, v in feature['properties'].items() if k in properties}
+            if precision is not None and feature.get('geometry') is not None:
+                feature['geometry']['coordinates'] = compact_coordinates(feature['geometry']['coordinates'], precision)
+        
+        _geometry_cache[key] = json_data
+    
+    return _geometry_cache[key]
+
+
+# YlOrRd colors (ColorBrewer, 5 classes) used by the maps with shared geometry
+MAP_COLORS = ['#ffffb2', '#fecc5c', '#fd8d3c', '#f03b20', '#bd0026']
+
+
+class SharedGeometryLayers(MacroElement):
+    """
+        folium element drawing several choropleth layers (one for each column of the data)
+        with a single copy of the geometry in the html page, the layers are chosen with a control
+    """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }}_geometry = {{ this.geometry|tojson }};
+        var {{ this.get_name() }}_colors = {{ this.colors|tojson }};
+        var {{ this.get_name() }}_layers = {};
+        {{ this.layer_names|tojson }}.forEach(function(name, i) {
+            var colors = {{ this.get_name() }}_colors[name];
+            var layer = L.geoJson({{ this.get_name() }}_geometry, {
+                style: function(feature) {
+                    return {fillColor: colors[feature.properties.{{ this.key }}] || '#000000',
+                            fillOpacity: {{ this.fill_opacity }}, color: '#000000',
+                            weight: 1, opacity: {{ this.line_opacity }}};
+                }
+            });
+            {{ this.get_name() }}_layers[name] = layer;
+            if (i == 0) { layer.addTo({{ this._parent.get_name() }}); }
+        });
+        L.control.layers({{ this.get_name() }}_layers, null, {collapsed: false})
+            .addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+    """)
+
+    def __init__(self, geometry, colors, key = 'LocationID', fill_opacity = 0.7, line_opacity = 0.2):
+        """
+            input:
+            - geometry: geojson dictionary (see load_geometry)
+            - colors: dictionary layer name -> {LocationID: color}
+            - key: property of the features with the LocationID
+        """
+        super().__init__()
+        self._name = 'SharedGeometryLayers'
+        self.geometry = geometry
+        self.colors = {name: {str(k): v for k, v in layer.items()} for name, layer in colors.items()}
+        self.layer_names = list(colors)
+        self.key = key
+        self.fill_opacity = fill_opacity
+        self.line_opacity = line_opacity
+
+
+def make_layers_map(geometry, PU_DO_occurrencies, types_of_LocID):
+    """
+        it creates a single folium map with a layer for each column in types_of_LocID,
+        all the layers share the same geometry (embedded only once in the html)
+        input:
+        - geometry: geojson dictionary (see load_geometry)
+        - PU_DO_occurrencies: dataframe with attributes:
+        'LocID' || 'PULocID_counts' || 'DOLocID_counts'
+        - types_of_LocID: list of columns requested (e.g. ['PULocID_counts', 'DOLocID_counts'])
+    """
+    m = folium.Map(location=[40.7128, -74.0060],control_scale=True, zoom_start=10.5)
+    folium.Marker([40.64, -73.77], popup='John F. Kennedy International Airport').add_to(m)
+    folium.Marker([40.7769, -73.8740], popup='LaGuardia Airport').add_to(m)
+    
+    colors = {}
+    
+    for type_of_LocID in types_of_LocID:
+        values = PU_DO_occurrencies[type_of_LocID].values
+        
+        # scale of each layer (referred to its min_max values), as in make_map
+        threshold_scale = np.linspace(values.min(), values.max(), len(MAP_COLORS) + 1)
+        classes = np.clip(np.searchsorted(threshold_scale, values, side='right') - 1, 0, len(MAP_COLORS) - 1)
+        colors[type_of_LocID] = {int(loc): MAP_COLORS[c] for loc, c in zip(PU_DO_occurrencies['LocID'], classes)}
+        
+        StepColormap(MAP_COLORS, index=threshold_scale.tolist(), vmin=threshold_scale[0],
+                     vmax=threshold_scale[-1], caption=type_of_LocID).add_to(m)
+    
+    SharedGeometryLayers(geometry, colors).add_to(m)
+    return m
 
-    return new_lst
+
+class ZoneHourCube:
+    """
+    Trips starting (pickups) and ending (dropoffs) in each zone, for each hour of the week
+    (Monday 00-01 is hour 0) or of the day: two dense uint32 arrays (LocationID x hour)
+    """
+
+    # number of hours of each period
+    PERIODS = {'week': 168, 'day': 24}
+
+    def __init__(self, size, period = 'week', pickups = None, dropoffs = None):
+        """
+        input:
+        - size: number of LocationIDs (max LocationID + 1, e.g. ZoneIndex.size)
+        - period: 'week' (168 hours) or 'day' (24 hours)
+        - pickups, dropoffs: (size x hours) arrays of counts (DEFAULT: all 0)
+        """
+        if period not in self.PERIODS:
+            raise ValueError("unknown period %s" %period)
+        self.size = size
+        self.period = period
+        hours = self.PERIODS[period]
+        self.pickups = np.zeros((size, hours), dtype='uint32') if pickups is None else np.asarray(pickups, dtype='uint32')
+        self.dropoffs = np.zeros((size, hours), dtype='uint32') if dropoffs is None else np.asarray(dropoffs, dtype='uint32')
+
+    def hours_of(self, datetimes):
+        """
+        Return the hour of the period (int64 array) of each datetime
+        """
+        hours = epoch_seconds(datetimes) // 3600
+        if self.period == 'day':
+            return hours % 24
+        # 1970-01-01 was a Thursday (the 4th day of the week)
+        return (hours + 3 * 24) % 168
+
+    def count(self, location_ids, datetimes):
+        """
+        Return a (size x hours) array counting the trips of each zone in each hour
+        """
+        ids = int_codes(location_ids)
+        hours = self.hours_of(datetimes)
+        n_hours = self.PERIODS[self.period]
+        keep = (ids >= 0) & (ids < self.size)
+        counts = np.bincount(ids[keep] * n_hours + hours[keep], minlength=self.size * n_hours)
+        return counts.reshape(self.size, n_hours).astype('uint32')
+
+    def update(self, pickup_ids, pickup_datetimes, dropoff_ids, dropoff_datetimes):
+        """
+        Add the trips of a chunk
+        """
+        self.pickups += self.count(pickup_ids, pickup_datetimes)
+        self.dropoffs += self.count(dropoff_ids, dropoff_datetimes)
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts of another ZoneHourCube (e.g. another month)
+        """
+        if self.period != other.period:
+            raise ValueError("cubes with different periods can't be merged")
+        self.pickups = self.pickups + other.pickups
+        self.dropoffs = self.dropoffs + other.dropoffs
+        return self
+
+    def labels(self):
+        """
+        Return the name of each hour of the period ('Mon 08:00', or '08:00')
+        """
+        if self.period == 'day':
+            return ['%02d:00' %h for h in range(24)]
+        days = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+        return ['%s %02d:00' %(days[h // 24], h % 24) for h in range(168)]
+
+    def save(self, path):
+        """
+        Save the cube in a compressed .npz file
+        """
+        np.savez_compressed(path, pickups=self.pickups, dropoffs=self.dropoffs, period=self.period)
+        return
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a cube saved with save
+        """
+        with np.load(path) as data:
+            return cls(data['pickups'].shape[0], str(data['period']), data['pickups'], data['dropoffs'])
+
+
+def zone_hour_cube_month(df_name, size, period = 'week', chunksize = None):
+    """
+        return the ZoneHourCube of a month, built in one pass over its chunks
+    """
+    cube = ZoneHourCube(size, period)
+    columns = ['PULocationID', 'tpep_pickup_datetime', 'DOLocationID', 'tpep_dropoff_datetime']
+    for chunk in iter_trips(df_name, columns, chunksize):
+        cube.update(*[chunk[col] for col in columns])
+    return cube
+
+
+@instrumented('analysis')
+def make_zone_hour_cube(df_names, taxi_zone_lookup, period = 'week', chunksize = None, processes = 1, path = None,
+                        aggregates = None):
+    """
+        return the ZoneHourCube of all the months
+        input:
+        - df_names
+        - taxi_zone_lookup (the cube has a row for each LocationID)
+        - period: 'week' (hours of the week) or 'day' (hours of the day)
+        - chunksize: if given, the files are read chunksize rows at a time (DEFAULT: None)
+        - processes: number of worker processes counting the months (DEFAULT: 1)
+        - path: if given, the cube is also saved there (load it with ZoneHourCube.load)
+        - aggregates: AggregateStore (or directory) with the cubes of the months already counted
+        output:
+        - a ZoneHourCube
+    """
+    cube = reduce_months(zone_hour_cube_month, df_names, zone_index(taxi_zone_lookup).size, period, chunksize,
+                         processes=processes, aggregates=aggregates)
+    if path is not None:
+        cube.save(path)
+    return cube
+
+
+class TimeSliderLayer(MacroElement):
+    """
+        folium element drawing a choropleth with a slider to choose the frame (e.g. the hour):
+        the geometry is embedded once and every frame is a string with the color class of each
+        LocationID (one character for each zone), the layer is restyled when the slider moves
+    """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }}_frames = {{ this.frames|tojson }};
+        var {{ this.get_name() }}_labels = {{ this.labels|tojson }};
+        var {{ this.get_name() }}_palette = {{ this.palette|tojson }};
+        function {{ this.get_name() }}_style(frame) {
+            return function(feature) {
+                var c = {{ this.get_name() }}_frames[frame].charAt(feature.properties.{{ this.key }});
+                return {fillColor: c ? {{ this.get_name() }}_palette[+c] : '#000000',
+                        fillOpacity: {{ this.fill_opacity }}, color: '#000000',
+                        weight: 1, opacity: {{ this.line_opacity }}};
+            };
+        }
+        var {{ this.get_name() }}_layer = L.geoJson({{ this.geometry|tojson }},
+            {style: {{ this.get_name() }}_style(0)}).addTo({{ this._parent.get_name() }});
+        var {{ this.get_name() }}_control = L.control({position: 'topright'});
+        {{ this.get_name() }}_control.onAdd = function() {
+            var div = L.DomUtil.create('div');
+            div.style.background = 'white';
+            div.style.padding = '6px';
+            div.innerHTML = '<input type="range" min="0" max="' + ({{ this.get_name() }}_frames.length - 1) +
+                            '" value="0" step="1" style="width:300px"/><div></div>';
+            L.DomEvent.disableClickPropagation(div);
+            var input = div.firstChild, label = div.lastChild;
+            label.innerHTML = {{ this.get_name() }}_labels[0];
+            input.oninput = function() {
+                {{ this.get_name() }}_layer.setStyle({{ this.get_name() }}_style(+this.value));
+                label.innerHTML = {{ this.get_name() }}_labels[+this.value];
+            };
+            return div;
+        };
+        {{ this.get_name() }}_control.addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+    """)
+
+    def __init__(self, geometry, frames, labels, palette, key = 'LocationID', fill_opacity = 0.7, line_opacity = 0.2):
+        """
+            input:
+            - geometry: geojson dictionary (see load_geometry)
+            - frames: list of strings, the ith character is the color class of LocationID i
+            - labels: name of each frame
+            - palette: color of each class
+            - key: property of the features with the LocationID
+        """
+        super().__init__()
+        self._name = 'TimeSliderLayer'
+        self.geometry = geometry
+        self.frames = frames
+        self.labels = labels
+        self.palette = palette
+        self.key = key
+        self.fill_opacity = fill_opacity
+        self.line_opacity = line_opacity
+
+
+def make_time_slider_map(geometry, counts, labels, legend_name):
+    """
+        it creates a folium map with a slider, showing a column of counts for each position
+        input:
+        - geometry: geojson dictionary (see load_geometry)
+        - counts: (LocationID x frames) array, e.g. ZoneHourCube.pickups
+        - labels: name of each frame
+        - legend_name
+    """
+    m = folium.Map(location=[40.7128, -74.0060],control_scale=True, zoom_start=10.5)
+    folium.Marker([40.64, -73.77], popup='John F. Kennedy International Airport').add_to(m)
+    folium.Marker([40.7769, -73.8740], popup='LaGuardia Airport').add_to(m)
+    
+    # the same scale for all the frames, so they can be compared (row 0 is not a LocationID)
+    threshold_scale = np.linspace(counts[1:].min(), counts[1:].max(), len(MAP_COLORS) + 1)
+    classes = np.clip(np.searchsorted(threshold_scale, counts, side='right') - 1, 0, len(MAP_COLORS) - 1)
+    
+    # one string for each frame: the character i is the class of LocationID i
+    frames = [''.join(map(str, classes[:, frame])) for frame in range(counts.shape[1])]
+    
+    StepColormap(MAP_COLORS, index=threshold_scale.tolist(), vmin=threshold_scale[0],
+                 vmax=threshold_scale[-1], caption=legend_name).add_to(m)
+    TimeSliderLayer(geometry, frames, labels, MAP_COLORS).add_to(m)
+    return m
+
+
+def time_slider_maps(cube, json_filename, precision = 5):
+    """
+        creates two maps with a time slider (pickups and dropoffs for each hour of the cube)
+        and return them into a list
+        input:
+        - cube: a ZoneHourCube (see make_zone_hour_cube)
+        - json_filename
+        - precision: decimals of the coordinates of the zones (DEFAULT: 5, None keeps them all)
+        output:
+        - list with two maps
+    """
+    geometry = load_geometry(json_filename, precision)
+    
+    return [make_time_slider_map(geometry, cube.pickups, cube.labels(), 'taxi pickups per hour'),
+            make_time_slider_map(geometry, cube.dropoffs, cube.labels(), 'taxi dropoffs per hour')]
 
 
 def make_map(json_data, PU_DO_occurrencies, type_of_LocID):
@@ -914,47 +4090,204 @@ def make_map(json_data, PU_DO_occurrencies, type_of_LocID):
     return m
 
 
-def pickup_and_dropoff_maps(df_names, taxi_zone_lookup, json_filename):
+class ODMatrix:
+    """
+    Origin-destination matrix: counts[PULocationID, DOLocationID] is the number of trips
+    from a zone to another one (dense uint32 array indexed by LocationID)
+    """
+
+    def __init__(self, size, counts = None):
+        """
+        input:
+        - size: number of LocationIDs (max LocationID + 1, e.g. ZoneIndex.size)
+        - counts: a (size x size) array of counts (DEFAULT: all 0)
+        """
+        self.size = size
+        if counts is None:
+            counts = np.zeros((size, size), dtype='uint32')
+        self.counts = np.asarray(counts, dtype='uint32')
+
+    def update(self, pickup_ids, dropoff_ids):
+        """
+        Add the trips of a chunk (ids outside the matrix are not counted)
+        input:
+        - PULocationID and DOLocationID columns of the chunk
+        """
+        pickup_ids = int_codes(pickup_ids)
+        dropoff_ids = int_codes(dropoff_ids)
+        
+        keep = (pickup_ids >= 0) & (pickup_ids < self.size) & (dropoff_ids >= 0) & (dropoff_ids < self.size)
+        counts = np.bincount(pickup_ids[keep] * self.size + dropoff_ids[keep], minlength=self.size * self.size)
+        
+        self.counts += counts.reshape(self.size, self.size).astype('uint32')
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts of another ODMatrix (e.g. another month)
+        """
+        self.counts = self.counts + other.counts
+        return self
+
+    def pickups(self):
+        """
+        Return the trips starting in each LocationID (row sums)
+        """
+        return self.counts.sum(axis=1, dtype='int64')
+
+    def dropoffs(self):
+        """
+        Return the trips ending in each LocationID (column sums)
+        """
+        return self.counts.sum(axis=0, dtype='int64')
+
+    def borough_flows(self, taxi_zone_lookup):
+        """
+        Return a dataframe with the trips from each borough (rows) to each borough (columns)
+        """
+        zones = zone_index(taxi_zone_lookup)
+        boroughs = zones.categories['Borough']
+        
+        codes = zones.codes_of(np.arange(self.size)).astype('int64')
+        known = codes >= 0
+        
+        # pair of borough codes for every cell of the matrix
+        pairs = (codes[known][:, None] * len(boroughs) + codes[known][None, :]).ravel()
+        flows = np.bincount(pairs, weights=self.counts[np.ix_(known, known)].ravel(),
+                            minlength=len(boroughs) ** 2)
+        
+        return pd.DataFrame(flows.reshape(len(boroughs), len(boroughs)).astype('int64'),
+                            index=boroughs, columns=boroughs)
+
+    def top_routes(self, k = 10, taxi_zone_lookup = None):
+        """
+        Return a dataframe with the k routes with more trips
+        (with their zones' names if taxi_zone_lookup is given)
+        """
+        flat = self.counts.ravel()
+        k = min(k, len(flat))
+        top = np.argpartition(flat, len(flat) - k)[len(flat) - k:]
+        top = top[np.argsort(flat[top])[::-1]]
+        
+        routes = pd.DataFrame({'PULocationID': top // self.size, 'DOLocationID': top % self.size,
+                               'trips': flat[top].astype('int64')})
+        
+        if taxi_zone_lookup is not None:
+            zones = zone_index(taxi_zone_lookup)
+            routes['PUZone'] = zones.lookup(routes['PULocationID'], 'Zone')
+            routes['DOZone'] = zones.lookup(routes['DOLocationID'], 'Zone')
+        return routes
+
+    def save(self, path):
+        """
+        Save the matrix in a .npy file
+        """
+        np.save(path, self.counts)
+        return
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a matrix saved with save
+        """
+        counts = np.load(path)
+        return cls(counts.shape[0], counts)
+
+
+def od_matrix_month(df_name, size, chunksize = None):
+    """
+        return the ODMatrix of a month, built in one pass over its chunks
+    """
+    od = ODMatrix(size)
+    for chunk in iter_trips(df_name, ['PULocationID', 'DOLocationID'], chunksize):
+        od.update(chunk['PULocationID'], chunk['DOLocationID'])
+    return od
+
+
+@instrumented('analysis')
+def make_od_matrix(df_names, taxi_zone_lookup, chunksize = None, processes = 1, path = None, aggregates = None):
+    """
+        return the ODMatrix of all the months
+        input:
+        - df_names
+        - taxi_zone_lookup (the matrix has a row and a column for each LocationID)
+        - chunksize: if given, the files are read chunksize rows at a time (DEFAULT: None)
+        - processes: number of worker processes counting the months (DEFAULT: 1)
+        - path: if given, the matrix is also saved there (load it with ODMatrix.load)
+        - aggregates: AggregateStore (or directory) with the matrices of the months already counted
+        output:
+        - an ODMatrix
+    """
+    od = reduce_months(od_matrix_month, df_names, zone_index(taxi_zone_lookup).size, chunksize,
+                       processes=processes, aggregates=aggregates)
+    if path is not None:
+        od.save(path)
+    return od
+
+
+def location_totals_month(df_name, n_zones, weights, chunksize = None):
+    """
+        return an array (2 x n_zones) with, for each LocationID, the sum of the column weights
+        over the trips starting there (first row) and ending there (second row), in one pass
+    """
+    res = np.zeros((2, n_zones), dtype='float64')
+    for chunk in iter_trips(df_name, ['PULocationID', 'DOLocationID', weights], chunksize):
+        res[0] += location_counts(chunk['PULocationID'], n_zones, chunk[weights])
+        res[1] += location_counts(chunk['DOLocationID'], n_zones, chunk[weights])
+    return res
+
+
+@instrumented('analysis')
+def pickup_and_dropoff_maps(df_names, taxi_zone_lookup, json_filename, processes = 1, weights = None,
+                            shared_geometry = False, precision = 5, aggregates = None):
     """
         creates two maps and return them into a list
         input:
         - df_names
         - taxi_zone_lookup
         - json_filename
+        - processes: number of worker processes counting the months (DEFAULT: 1)
+        - weights: column to sum in each zone instead of counting the trips
+          ('passenger_count', 'fare_amount', 'trip_distance'...) (DEFAULT: None)
+        - shared_geometry: if True, return a list with a single map with the two layers,
+          which share one copy of the geometry (DEFAULT: False)
+        - precision: decimals of the coordinates of the zones (DEFAULT: 5, None keeps them all)
+        - aggregates: AggregateStore (or directory) with the counts of the months already counted
         output:
         - list with two maps
     """
     
-    #importing json data
-    json_data = json.load(open(json_filename))
+    #importing json data (parsed and compacted only the first time)
+    json_data = load_geometry(json_filename, precision)
     
     # declaring the map list
     maps_list = []
     
-    # creating a new data frame and load it
-    df = pd.DataFrame()
-    df = take_pickup_and_dropoff_zones(df_names,taxi_zone_lookup)
+    n_zones = zone_index(taxi_zone_lookup).size - 1
     
-    # loading into a list the counter for each LocationID
-    # we will put the two lists into a new dataframe
-    PU_list = []
-    DO_list = []
-    
-    PU_list = Locations_counter(df,'PULocationID')
-    DO_list = Locations_counter(df,'DOLocationID')
-    
-    # df is not needed anymore
-    del df
+    if weights is None:
+        # origin-destination matrix of all the months:
+        # trips starting and ending in each LocationID are its row and column sums
+        od = make_od_matrix(df_names, taxi_zone_lookup, processes=processes, aggregates=aggregates)
+        PU_list = od.pickups()[1:]
+        DO_list = od.dropoffs()[1:]
+    else:
+        PU_list, DO_list = reduce_months(location_totals_month, df_names, n_zones, weights, processes=processes,
+                                         aggregates=aggregates)
     
     # creating a new dataframe
     # PU_DO_occurrencies will contain 3 columns:
     # Location ID || PULocationID_counter || DOLocationID_counter
     PU_DO_occurrencies = pd.DataFrame()
     
-    PU_DO_occurrencies['LocID'] = list(range(1,266))
+    PU_DO_occurrencies['LocID'] = list(range(1,n_zones+1))
     PU_DO_occurrencies['PULocID_counts'] = PU_list
     PU_DO_occurrencies['DOLocID_counts'] = DO_list
     
+    if shared_geometry:
+        maps_list.append(make_layers_map(json_data, PU_DO_occurrencies, ['PULocID_counts', 'DOLocID_counts']))
+        return maps_list
+    
     maps_list.append(make_map(json_data,PU_DO_occurrencies, 'PULocID_counts'))
     maps_list.append(make_map(json_data,PU_DO_occurrencies, 'DOLocID_counts'))
     
@@ -0,0 +1,223 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import functions
+
+
+RAW_COLUMNS = ['VendorID', 'tpep_pickup_datetime', 'tpep_dropoff_datetime', 'passenger_count', 'trip_distance',
+               'RatecodeID', 'store_and_fwd_flag', 'PULocationID', 'DOLocationID', 'payment_type', 'fare_amount',
+               'extra', 'mta_tax', 'tip_amount', 'tolls_amount', 'improvement_surcharge', 'total_amount']
+
+
+def raw_trips(n, month = 1, **columns):
+    """
+    Return a raw month of n trips (the given columns replace the default values)
+    """
+    pickups = pd.Timestamp(2018, month, 1) + pd.to_timedelta(np.arange(n) * 60, unit='s')
+    df = pd.DataFrame({'VendorID': 1,
+                       'tpep_pickup_datetime': pickups.strftime(functions.TLC_DATETIME_FORMAT),
+                       'tpep_dropoff_datetime': (pickups + pd.Timedelta(minutes=10)).strftime(functions.TLC_DATETIME_FORMAT),
+                       'passenger_count': 1, 'trip_distance': 1.5, 'RatecodeID': 1, 'store_and_fwd_flag': 'N',
+                       'PULocationID': 161, 'DOLocationID': 236, 'payment_type': 1, 'fare_amount': 8.0,
+                       'extra': 0.5, 'mta_tax': 0.5, 'tip_amount': 0.0, 'tolls_amount': 0,
+                       'improvement_surcharge': 0.3, 'total_amount': 9.3}, index=range(n))
+    for col, values in columns.items():
+        df[col] = values
+    return df[RAW_COLUMNS]
+
+
+def write_raw(path, frames):
+    """
+    Write the frames one after the other in a csv file (each one with its own number formats)
+    """
+    for j, df in enumerate(frames):
+        df.to_csv(path, mode='w' if j == 0 else 'a', header=(j == 0), index=False)
+
+
+@pytest.mark.parametrize('file_format', ['parquet', 'feather'])
+def test_chunks_with_different_inferred_dtypes(tmp_path, file_format):
+    # first chunk: integer tolls, no missing values; second chunk: float tolls, missing passenger_count
+    # and store_and_fwd_flag; third chunk: trips of another month only (empty after the cleaning)
+    first = raw_trips(4)
+    second = raw_trips(4, tolls_amount=[0.0, 5.76, 0.0, 5.76], passenger_count=[1, np.nan, 2, 1],
+                       RatecodeID=[1, 1, np.nan, 1], store_and_fwd_flag=np.nan)
+    third = raw_trips(4, month=2)
+    raw = tmp_path / 'raw_2018-01.csv'
+    write_raw(raw, [first, second, third])
+
+    chunked = str(tmp_path / ('chunked' + functions.BINARY_FORMATS[file_format]))
+    whole = str(tmp_path / ('whole' + functions.BINARY_FORMATS[file_format]))
+    functions.clean_month_file(str(raw), chunked, 1, file_format=file_format, chunksize=4)
+    functions.clean_month_file(str(raw), whole, 1, file_format=file_format)
+
+    res = functions.read_trips(chunked)
+    pd.testing.assert_frame_equal(res, functions.read_trips(whole))
+    assert len(res) == 8
+    assert res['passenger_count'].isna().sum() == 1
+    assert str(res['passenger_count'].dtype) == 'UInt8'
+    assert sorted(os.listdir(tmp_path)) == sorted(['raw_2018-01.csv', os.path.basename(chunked), os.path.basename(whole)])
+
+
+@pytest.mark.parametrize('file_format', ['parquet', 'feather'])
+def test_empty_first_chunk(tmp_path, file_format):
+    raw = tmp_path / 'raw_2018-01.csv'
+    write_raw(raw, [raw_trips(3, month=2, passenger_count=np.nan), raw_trips(3, tolls_amount=5.76)])
+
+    new_name = str(tmp_path / ('new' + functions.BINARY_FORMATS[file_format]))
+    functions.clean_month_file(str(raw), new_name, 1, file_format=file_format, chunksize=3)
+
+    res = functions.read_trips(new_name)
+    assert len(res) == 3
+    assert (res['tpep_pickup_datetime'].dt.month == 1).all()
+
+
+def test_failed_write_leaves_no_file(tmp_path):
+    def chunks():
+        yield raw_trips(3)
+        raise RuntimeError('broken chunk')
+
+    new_name = str(tmp_path / 'new.parquet')
+    with pytest.raises(RuntimeError):
+        functions.write_trips_chunks(chunks(), new_name, 'parquet')
+    assert os.listdir(tmp_path) == []
+
+
+def test_missing_dimension_codes(tmp_path):
+    # RatecodeID and VendorID are read only by the contingency tables: their missing values
+    # don't affect the other analyses
+    raw = tmp_path / 'raw_2018-01.csv'
+    write_raw(raw, [raw_trips(4, RatecodeID=[1, np.nan, 2, 1], VendorID=[1, 2, np.nan, 1])])
+    new_name = functions.clean_month_file(str(raw), str(tmp_path / 'new.parquet'), 1, file_format='parquet')
+
+    functions.clear_trip_store()
+    assert len(functions.compute_daily_average([new_name])) == 1
+    assert len(functions.passengers_NY_all_months([new_name])) == 4
+
+    zones = functions.ZoneIndex(pd.DataFrame({'LocationID': [161, 236], 'Borough': 'Manhattan',
+                                              'Zone': ['Midtown Center', 'Upper East Side North'],
+                                              'service_zone': 'Yellow Zone'}))
+    for chunksize in [None, 2]:
+        res = functions.contingency_month(new_name, 'RatecodeID', 'VendorID', zones, chunksize)
+        assert res.counts.sum() == 2
+        assert res.counts[1, 1] == 2
+
+
+@pytest.mark.parametrize('chunksize', [None, 3])
+def test_quality_report_with_missing_and_wrong_codes(tmp_path, chunksize):
+    raw = tmp_path / 'raw_2018-01.csv'
+    write_raw(raw, [raw_trips(6, passenger_count=[1, np.nan, 2, np.nan, 300, 1],
+                              RatecodeID=[1, np.nan, 99, 1, 1, 1.5], PULocationID=[161, 0, np.nan, 161, 999, 161],
+                              tpep_dropoff_datetime=['2018-01-01 00:10:00', 'not a date', np.nan,
+                                                     '2018-01-01 00:20:00', '2018-01-01 00:30:00', '2017-12-31 23:00:00'])])
+
+    res = functions.stats([str(raw)], chunksize=chunksize).loc['all']
+    assert res['rows'] == 6
+    assert res['null rate passenger_count'] == pytest.approx(2 / 6)
+    assert res['null rate RatecodeID'] == pytest.approx(1 / 6)
+    assert res['null rate tpep_dropoff_datetime'] == pytest.approx(2 / 6)
+    assert res['passenger_count=1'] == 2 and res['passenger_count=other'] == 1
+    assert res['RatecodeID=99'] == 1 and res['RatecodeID=other'] == 1
+    assert res['PULocationID out of range'] == 2
+    assert res['dropoff before pickup'] == 1
+
+
+def test_location_counts_of_nullable_columns(tmp_path):
+    raw = tmp_path / 'raw_2018-01.csv'
+    write_raw(raw, [raw_trips(4, PULocationID=[1, 2, 2, 265], DOLocationID=[3, np.nan, 3, 1],
+                              passenger_count=[1, 2, np.nan, 4])])
+    new_name = functions.clean_month_file(str(raw), str(tmp_path / 'new.parquet'), 1, file_format='parquet')
+    df = functions.read_trips(new_name)
+    assert str(df['DOLocationID'].dtype) == 'UInt16'
+
+    # the nullable arrays are a single chunk: missing ids aren't counted, missing weights count as 0
+    counts = functions.location_counts(df['DOLocationID'].values, 265)
+    assert counts[[0, 2]].tolist() == [1, 2] and counts.sum() == 3
+    weighted = functions.location_counts(df['PULocationID'].values, 265, df['passenger_count'].values)
+    assert weighted[[0, 1, 264]].tolist() == [1, 2, 4]
+
+    for chunksize in [None, 2]:
+        res = functions.location_totals_month(new_name, 265, 'passenger_count', chunksize)
+        assert res[0, [0, 1, 264]].tolist() == [1, 2, 4]
+        assert res[1, [0, 2]].tolist() == [4, 1] and res[1].sum() == 5
+
+
+def test_quality_reports_saved_once_per_month(tmp_path):
+    names = []
+    for month in [1, 2]:
+        names.append(str(tmp_path / ('raw_2018-%02d.csv' %month)))
+        write_raw(names[-1], [raw_trips(3, month=month)])
+    aggregates = str(tmp_path / 'agg')
+
+    first = functions.stats(names[:1], aggregates=aggregates)
+    saved = set(os.listdir(os.path.join(aggregates, 'quality_report_month')))
+    assert len(saved) == 1
+
+    # adding February keeps the key of January: only February is computed and saved
+    both = functions.stats(names, aggregates=aggregates)
+    assert saved < set(os.listdir(os.path.join(aggregates, 'quality_report_month')))
+    assert len(os.listdir(os.path.join(aggregates, 'quality_report_month'))) == 2
+    assert both.loc[names[0]].equals(first.loc[names[0]])
+    assert both.loc['all', 'out of month'] == 0
+
+
+@pytest.mark.parametrize('file_format', ['csv', 'parquet'])
+def test_trip_store_reads(tmp_path, file_format):
+    raw = tmp_path / 'raw_2018-01.csv'
+    write_raw(raw, [raw_trips(5)])
+    extension = '.csv' if file_format == 'csv' else functions.BINARY_FORMATS[file_format]
+    new_name = functions.clean_month_file(str(raw), str(tmp_path / ('new' + extension)), 1, file_format=file_format)
+
+    functions.clear_trip_store()
+    events = []
+    with functions.instrumentation(events.append):
+        functions.load_trips(new_name, ['trip_distance'])
+        df = functions.load_trips(new_name, ['PULocationID', 'fare_amount'])
+    reads = [event['columns'] for event in events if event['stage'] == 'read']
+    assert df.columns.tolist() == ['PULocationID', 'fare_amount'] and len(df) == 5
+
+    # a csv month is parsed once for all the columns, binary files read only the missing ones
+    if file_format == 'csv':
+        assert len(reads) == 1
+    else:
+        assert reads == [['trip_distance'], ['PULocationID', 'fare_amount']]
+
+    # the budget is respected
+    functions.set_trip_store_budget(0)
+    assert len(functions._trip_store) == 0
+    assert len(functions.load_trips(new_name, ['trip_distance'])) == 5
+    assert len(functions._trip_store) == 0
+    functions.set_trip_store_budget(2 << 30)
+
+
+def test_aggregate_keys_change_with_the_kernel(tmp_path, monkeypatch):
+    month = tmp_path / 'raw_2018-01.csv'
+    write_raw(month, [raw_trips(3)])
+    store = functions.AggregateStore(str(tmp_path / 'agg'))
+
+    def kernel(df_name):
+        return 1
+    first = store.path_of(kernel, str(month), ())
+    assert store.get(kernel, str(month)) == 1
+
+    # same name, other code: the saved result isn't reused
+    def kernel(df_name):
+        return 2
+    second = store.path_of(kernel, str(month), ())
+    assert second != first
+    assert store.get(kernel, str(month)) == 2
+
+    monkeypatch.setattr(functions, 'AGGREGATES_VERSION', functions.AGGREGATES_VERSION + 1)
+    assert store.path_of(kernel, str(month), ()) not in (first, second)
+
+
+def test_merge_partials():
+    assert functions.merge_partials([1, 2, 3]) == 6
+    res = functions.merge_partials([pd.Series([1, 2], index=['a', 'b']), pd.Series([3], index=['b'])])
+    assert res.to_dict() == {'a': 1, 'b': 5}
+    with pytest.raises(ValueError):
+        functions.merge_partials([])
+    with pytest.raises(ValueError):
+        functions.reduce_months(functions.od_matrix_month, [], 266)